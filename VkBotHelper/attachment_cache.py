@@ -0,0 +1,65 @@
+import logging
+import threading
+from collections import OrderedDict
+
+import config
+
+# Кэш вложений VK: (file_unique_id Telegram, ID цели VK) -> вложение в формате type{owner_id}_{id}.
+# Первый уровень - LRU в памяти процесса, второй - таблица post_media (file_id, vk_attachment_id),
+# цель VK берется из связанной записи posts.
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+def _remember(file_unique_id, vk_target_id, attachment):
+    """Записывает вложение в LRU, вытесняя давно не использованные записи"""
+    with _lock:
+        _cache[(file_unique_id, vk_target_id)] = attachment
+        _cache.move_to_end((file_unique_id, vk_target_id))
+        while len(_cache) > config.ATTACHMENT_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+def get(file_unique_id, vk_target_id):
+    """Возвращает вложение VK для файла Telegram из LRU или None"""
+    if not file_unique_id or not vk_target_id:
+        return None
+    with _lock:
+        attachment = _cache.get((file_unique_id, vk_target_id))
+        if attachment:
+            _cache.move_to_end((file_unique_id, vk_target_id))
+        return attachment
+
+def remember(file_unique_id, vk_target_id, attachment):
+    """Запоминает вложение VK, загруженное для файла Telegram (в базу оно попадает через log_post)"""
+    if file_unique_id and vk_target_id and attachment:
+        _remember(file_unique_id, vk_target_id, attachment)
+
+def prefetch(file_unique_ids, vk_target_ids):
+    """Подгружает в LRU вложения для файлов и целей VK одним запросом к post_media
+
+    Возвращает множество file_unique_id, для которых вложение есть во всех целях,
+    такие файлы не нужно скачивать из Telegram.
+    """
+    file_unique_ids = [uid for uid in file_unique_ids if uid]
+    vk_target_ids = [target for target in vk_target_ids if target]
+    if not file_unique_ids or not vk_target_ids:
+        return set()
+
+    missing = {uid for uid in file_unique_ids for target in vk_target_ids if not get(uid, target)}
+    supabase = config.supabase
+    if missing and supabase:
+        try:
+            response = supabase.table("post_media")\
+                .select("file_id,vk_attachment_id,posts!inner(vk_target_id)")\
+                .in_("file_id", sorted(missing))\
+                .in_("posts.vk_target_id", vk_target_ids)\
+                .order("id", desc=True)\
+                .execute()
+
+            for row in reversed(response.data or []):
+                post = row.get("posts") or {}
+                if row.get("vk_attachment_id") and post.get("vk_target_id"):
+                    _remember(row["file_id"], post["vk_target_id"], row["vk_attachment_id"])
+        except Exception as e:
+            logging.warning(f"Не удалось получить кэш вложений VK из базы: {e}")
+
+    return {uid for uid in file_unique_ids if all(get(uid, target) for target in vk_target_ids)}
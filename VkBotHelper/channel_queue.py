@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+import config
+
+# Очереди публикации по каналам: задачи одного канала выполняются строго по очереди (FIFO),
+# а задачи разных каналов - параллельно пулом из CHANNEL_QUEUE_WORKERS обработчиков.
+
+# Ожидающие задачи: ключ канала -> deque из [момент постановки, фабрика корутины, описание, ждать при остановке];
+# фабрика None - место, занятое задачей, которая еще не готова (см. reserve)
+_queues = {}
+# Каналы, которые стоят в _ready или сейчас обрабатываются - у канала не больше одной активной задачи
+_scheduled = set()
+# Очередь каналов, у которых есть задачи, создается при первом использовании
+_ready = None
+_workers = []
+_reporter = None
+
+# Статистика каналов за интервал отчета: ключ канала -> {"name", "max_depth", "processed", "wait_total", "wait_max"}
+_stats = {}
+
+def _channel_stats(key):
+    stats = _stats.get(key)
+    if stats is None:
+        stats = {"name": None, "max_depth": 0, "processed": 0, "wait_total": 0.0, "wait_max": 0.0}
+        _stats[key] = stats
+    return stats
+
+def submit(key, factory, label=None, name=None):
+    """Ставит задачу в очередь канала
+
+    factory - функция без аргументов, возвращающая корутину; она вызывается, когда
+    подходит очередь задачи, после завершения всех ранее поставленных задач канала.
+    """
+    _enqueue(key, factory, label, name)
+
+def reserve(key, label=None, name=None, first=False, drain=True):
+    """Занимает место в очереди канала для задачи, которая будет готова позже
+
+    Задачи канала, поставленные после, ждут ее, но обработчик на время ожидания не занимается.
+    first - место в начале очереди (повтор задачи, которая только что выполнялась),
+    drain - дожидаться ли задачи при остановке (stop), если она еще не готова.
+    Возвращает функцию resolve(factory): после ее вызова задача выполняется в свою очередь.
+    """
+    entry = _enqueue(key, None, label, name, first, drain)
+
+    def resolve(factory):
+        # Ожидание в очереди считается с момента, когда задача готова
+        entry[0] = time.monotonic()
+        entry[1] = factory
+        _wake(key)
+
+    return resolve
+
+def _enqueue(key, factory, label, name, first=False, drain=True):
+    _ensure_workers()
+
+    queue = _queues.setdefault(key, deque())
+    entry = [time.monotonic(), factory, label, drain]
+    if first:
+        queue.appendleft(entry)
+    else:
+        queue.append(entry)
+
+    stats = _channel_stats(key)
+    if name:
+        stats["name"] = name
+    stats["max_depth"] = max(stats["max_depth"], len(queue))
+
+    _wake(key)
+    return entry
+
+def _wake(key):
+    """Ставит канал в очередь каналов, если у него нет активной задачи и первая задача готова"""
+    queue = _queues.get(key)
+    if key in _scheduled or not queue or queue[0][1] is None:
+        return
+    _scheduled.add(key)
+    _ready.put_nowait(key)
+
+def depth(key):
+    """Сколько задач канала ожидает выполнения"""
+    queue = _queues.get(key)
+    return len(queue) if queue else 0
+
+def pending():
+    """Сколько задач ожидает выполнения во всех каналах"""
+    return sum(len(queue) for queue in _queues.values())
+
+def stats():
+    """Возвращает статистику каналов за текущий интервал отчета"""
+    return {
+        key: {
+            "name": item["name"],
+            "depth": depth(key),
+            "max_depth": item["max_depth"],
+            "processed": item["processed"],
+            "wait_avg": item["wait_total"] / item["processed"] if item["processed"] else 0.0,
+            "wait_max": item["wait_max"],
+        }
+        for key, item in _stats.items()
+    }
+
+async def _worker():
+    while True:
+        key = await _ready.get()
+        queue = _queues[key]
+        enqueued_at, factory, label, _ = queue.popleft()
+
+        wait = time.monotonic() - enqueued_at
+        stats = _channel_stats(key)
+        stats["processed"] += 1
+        stats["wait_total"] += wait
+        stats["wait_max"] = max(stats["wait_max"], wait)
+        if config.CHANNEL_QUEUE_SLOW_WAIT and wait > config.CHANNEL_QUEUE_SLOW_WAIT:
+            logging.warning(f"Задача {label} канала {key} ждала в очереди {wait:.1f} с, в очереди еще {len(queue)}")
+
+        try:
+            await factory()
+        except Exception as e:
+            logging.error(f"Ошибка при выполнении задачи {label} канала {key}: {e}")
+        finally:
+            _scheduled.discard(key)
+            if queue:
+                # Канал встает в конец очереди каналов, чтобы остальные каналы не ждали его
+                _wake(key)
+            else:
+                del _queues[key]
+
+def report():
+    """Пишет в лог глубину очередей и время ожидания по каналам и начинает новый интервал"""
+    for key, item in stats().items():
+        if not item["processed"] and not item["depth"]:
+            continue
+        name = f"@{item['name']}" if item["name"] else key
+        logging.info(
+            f"Очередь канала {name}: ожидает {item['depth']} (макс. {item['max_depth']}), "
+            f"выполнено {item['processed']}, ожидание ср. {item['wait_avg']:.2f} с, макс. {item['wait_max']:.2f} с"
+        )
+    _stats.clear()
+
+async def _report_loop():
+    while True:
+        await asyncio.sleep(config.CHANNEL_QUEUE_REPORT_INTERVAL)
+        try:
+            report()
+        except Exception as e:
+            logging.error(f"Ошибка при формировании отчета об очередях каналов: {e}")
+
+def _ensure_workers():
+    """Запускает обработчики очередей и отчеты в текущем цикле событий"""
+    global _ready, _reporter
+    if _ready is None:
+        _ready = asyncio.Queue()
+    if not _workers:
+        _workers.extend(asyncio.create_task(_worker()) for _ in range(config.CHANNEL_QUEUE_WORKERS))
+    if config.CHANNEL_QUEUE_REPORT_INTERVAL and (_reporter is None or _reporter.done()):
+        _reporter = asyncio.create_task(_report_loop())
+
+def _draining():
+    """Есть ли задачи, которых нужно дождаться при остановке: готовые, выполняемые и места с drain"""
+    return bool(_scheduled) or any(
+        factory is None and drain
+        for queue in _queues.values()
+        for _, factory, _, drain in queue
+    )
+
+async def stop(timeout=None):
+    """Дожидается выполнения поставленных задач (не дольше timeout секунд) и останавливает обработчики
+
+    Места, занятые с drain=False (например, отложенные повторы), не ждутся.
+    """
+    global _ready, _reporter
+
+    timeout = config.CHANNEL_QUEUE_DRAIN_TIMEOUT if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+    while _draining() and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    if _draining():
+        logging.warning(f"Остановка с невыполненными задачами в очередях каналов: {pending()}")
+
+    tasks = [task for task in [*_workers, _reporter] if task is not None]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _workers.clear()
+    _queues.clear()
+    _scheduled.clear()
+    _ready = None
+    _reporter = None
@@ -6,8 +6,6 @@ import datetime
 import requests
 from dotenv import load_dotenv
 from supabase import create_client, Client
-from vk_api import VkApi
-from vk_api.utils import get_random_id
 
 load_dotenv()
 
@@ -41,10 +39,122 @@ TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 VK_API_TOKEN = os.getenv('VK_API_TOKEN')
 VK_GROUP_ID = os.getenv('VK_GROUP_ID')
 
+# Локальный сервер Telegram Bot API (telegram-bot-api --local): нет ограничения на размер файлов,
+# а get_file возвращает путь к файлу в файловой системе сервера, который открывается без скачивания
+TELEGRAM_LOCAL_MODE = os.getenv('TELEGRAM_LOCAL_MODE', '0').lower() in ('1', 'true', 'yes')
+TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL')  # например http://localhost:8081/bot
+TELEGRAM_API_BASE_FILE_URL = os.getenv('TELEGRAM_API_BASE_FILE_URL')  # например http://localhost:8081/file/bot
+# Если сервер работает в другом контейнере: его рабочий каталог и путь, по которому этот каталог смонтирован у бота
+TELEGRAM_LOCAL_SERVER_DIR = os.getenv('TELEGRAM_LOCAL_SERVER_DIR', '')
+TELEGRAM_LOCAL_FILES_DIR = os.getenv('TELEGRAM_LOCAL_FILES_DIR', '')
+
+# Видео больше MAX_VIDEO_SIZE байт публикуются ссылкой на пост, 0 - без ограничения (по умолчанию в локальном режиме)
+MAX_VIDEO_SIZE = int(os.getenv('MAX_VIDEO_SIZE', '0' if TELEGRAM_LOCAL_MODE else str(100 * 1024 * 1024)))
+
+# Индекс маршрутизации каналов: полная перезагрузка раз в ROUTING_INDEX_TTL секунд,
+# проверка crosspost_settings.updated_at раз в ROUTING_INDEX_POLL_INTERVAL секунд
+ROUTING_INDEX_TTL = int(os.getenv('ROUTING_INDEX_TTL', '600'))
+ROUTING_INDEX_POLL_INTERVAL = int(os.getenv('ROUTING_INDEX_POLL_INTERVAL', '30'))
+# Каналы загружаются в индекс страницами: не больше max-rows PostgREST (в Supabase по умолчанию 1000)
+ROUTING_INDEX_PAGE_SIZE = int(os.getenv('ROUTING_INDEX_PAGE_SIZE', '1000'))
+
+# Локальный UDP-адрес, на который админка отправляет уведомления об изменении настроек
+SETTINGS_EVENTS_HOST = os.getenv('SETTINGS_EVENTS_HOST', '127.0.0.1')
+SETTINGS_EVENTS_PORT = int(os.getenv('SETTINGS_EVENTS_PORT', '8765'))
+
+# Сколько секунд помнить, что канал не отслеживается (сообщения из него пропускаются без запросов к базе)
+UNTRACKED_CHANNEL_TTL = int(os.getenv('UNTRACKED_CHANNEL_TTL', '300'))
+
+# Пул клиентов VK API: не больше VK_POOL_SIZE целей, простаивающие дольше VK_POOL_IDLE_TTL секунд закрываются
+VK_POOL_SIZE = int(os.getenv('VK_POOL_SIZE', '32'))
+VK_POOL_IDLE_TTL = int(os.getenv('VK_POOL_IDLE_TTL', '900'))
+VK_POOL_CONNECTIONS = int(os.getenv('VK_POOL_CONNECTIONS', '10'))
+
+# Асинхронный клиент VK API (vk_async)
+VK_API_URL = os.getenv('VK_API_URL', 'https://api.vk.com/method')
+VK_API_VERSION = os.getenv('VK_API_VERSION', '5.131')
+VK_API_RPS = float(os.getenv('VK_API_RPS', '3'))
+VK_HTTP_TIMEOUT = float(os.getenv('VK_HTTP_TIMEOUT', '300'))
+# Сколько файлов одновременно загружать в одну цель VK
+VK_UPLOAD_CONCURRENCY = int(os.getenv('VK_UPLOAD_CONCURRENCY', '3'))
+
+# Режим пакетной публикации: сохранение вложений и wall.post одним вызовом execute
+VK_EXECUTE_BATCH = os.getenv('VK_EXECUTE_BATCH', '0').lower() in ('1', 'true', 'yes')
+
+# Типы вложений (photo, video, doc, audio через запятую), которые передаются из Telegram в VK
+# потоком через буфер из STREAM_BUFFER_CHUNKS блоков по STREAM_CHUNK_SIZE байт, без записи на диск
+STREAM_MEDIA_TYPES = [kind.strip() for kind in os.getenv('STREAM_MEDIA_TYPES', '').split(',') if kind.strip()]
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', str(256 * 1024)))
+STREAM_BUFFER_CHUNKS = int(os.getenv('STREAM_BUFFER_CHUNKS', '8'))
+
+# Файлы до MEDIA_MEMORY_THRESHOLD байт скачиваются из Telegram в память, большие - во временный файл в TEMP_DIR
+MEDIA_MEMORY_THRESHOLD = int(os.getenv('MEDIA_MEMORY_THRESHOLD', str(5 * 1024 * 1024)))
+
+# Сколько вложений VK (file_unique_id, цель VK) держать в памяти, остальные берутся из post_media
+ATTACHMENT_CACHE_SIZE = int(os.getenv('ATTACHMENT_CACHE_SIZE', '4096'))
+
+# Подготовка фото перед загрузкой в VK: уменьшение до PHOTO_MAX_SIDE пикселей по большей стороне
+# и перекодирование в JPEG с качеством PHOTO_JPEG_QUALITY в пуле из PHOTO_WORKERS потоков
+PHOTO_TRANSFORM = os.getenv('PHOTO_TRANSFORM', '1').lower() in ('1', 'true', 'yes')
+PHOTO_MAX_SIDE = int(os.getenv('PHOTO_MAX_SIDE', '2560'))
+PHOTO_JPEG_QUALITY = int(os.getenv('PHOTO_JPEG_QUALITY', '85'))
+PHOTO_WORKERS = int(os.getenv('PHOTO_WORKERS', '2'))
+
+# Альбом публикуется через MEDIA_GROUP_IDLE_TIMEOUT секунд после последней полученной части,
+# но не позже MEDIA_GROUP_MAX_WAIT секунд после первой
+MEDIA_GROUP_IDLE_TIMEOUT = float(os.getenv('MEDIA_GROUP_IDLE_TIMEOUT', '1.0'))
+MEDIA_GROUP_MAX_WAIT = float(os.getenv('MEDIA_GROUP_MAX_WAIT', '10'))
+
+# Временные файлы в TEMP_DIR (scratch_space): квота в байтах, сколько секунд ждать свободного места
+# перед передачей файла потоком, период фоновой очистки и возраст файлов без владельца, после которого они удаляются
+SCRATCH_QUOTA_BYTES = int(os.getenv('SCRATCH_QUOTA_BYTES', str(2 * 1024 * 1024 * 1024)))
+SCRATCH_RESERVE_TIMEOUT = float(os.getenv('SCRATCH_RESERVE_TIMEOUT', '30'))
+SCRATCH_SWEEP_INTERVAL = int(os.getenv('SCRATCH_SWEEP_INTERVAL', '300'))
+SCRATCH_ORPHAN_TTL = int(os.getenv('SCRATCH_ORPHAN_TTL', '3600'))
+# Сколько резервировать для файла, размер которого Telegram не сообщил: предел скачивания Bot API
+# (20 МБ, у локального сервера - 2000 МБ)
+SCRATCH_UNKNOWN_SIZE = int(os.getenv(
+    'SCRATCH_UNKNOWN_SIZE', str((2000 if TELEGRAM_LOCAL_MODE else 20) * 1024 * 1024)
+))
+
+# Сколько обновлений Telegram обрабатывается одновременно (Application.concurrent_updates)
+TELEGRAM_CONCURRENT_UPDATES = int(os.getenv('TELEGRAM_CONCURRENT_UPDATES', '16'))
+
+# Очереди каналов (channel_queue): число обработчиков, общих для всех каналов, период отчета
+# о глубине очередей и ожидании (0 - без отчетов), ожидание, после которого задача попадает в лог,
+# и сколько секунд при остановке дожидаться уже поставленных задач
+CHANNEL_QUEUE_WORKERS = int(os.getenv('CHANNEL_QUEUE_WORKERS', '8'))
+CHANNEL_QUEUE_REPORT_INTERVAL = int(os.getenv('CHANNEL_QUEUE_REPORT_INTERVAL', '300'))
+CHANNEL_QUEUE_SLOW_WAIT = float(os.getenv('CHANNEL_QUEUE_SLOW_WAIT', '60'))
+CHANNEL_QUEUE_DRAIN_TIMEOUT = float(os.getenv('CHANNEL_QUEUE_DRAIN_TIMEOUT', '30'))
+
+# Режим вебхука (--webhook): публичный адрес бота, на котором Telegram ждет HTTPS, адрес и порт
+# встроенного HTTP-сервера, путь, секрет для заголовка X-Telegram-Bot-Api-Secret-Token
+# (если не задан, создается при запуске) и сертификат, если TLS завершается в самом боте
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # например https://bot.example.com:8443
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN', '')
+WEBHOOK_CERT = os.getenv('WEBHOOK_CERT', '')
+WEBHOOK_KEY = os.getenv('WEBHOOK_KEY', '')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+WEBHOOK_MAX_BODY = int(os.getenv('WEBHOOK_MAX_BODY', str(1024 * 1024)))
+
+# Очередь публикаций (outbox): файл SQLite, срок аренды задачи обработчиком (продлевается, пока
+# задача выполняется), число попыток и задержка между ними (удваивается от OUTBOX_RETRY_BASE до OUTBOX_RETRY_MAX)
+OUTBOX_PATH = os.getenv('OUTBOX_PATH', os.path.join(BASE_DIR, 'outbox.sqlite3'))
+OUTBOX_LEASE_SECONDS = int(os.getenv('OUTBOX_LEASE_SECONDS', '60'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '8'))
+OUTBOX_RETRY_BASE = float(os.getenv('OUTBOX_RETRY_BASE', '5'))
+OUTBOX_RETRY_MAX = float(os.getenv('OUTBOX_RETRY_MAX', '900'))
+
+# Сколько файлов медиагруппы скачивать из Telegram одновременно
+TELEGRAM_DOWNLOAD_CONCURRENCY = int(os.getenv('TELEGRAM_DOWNLOAD_CONCURRENCY', '4'))
+
 # Глобальные переменные для работы с клиентами
+# Клиенты VK не хранятся глобально: см. vk_pool и publish_context.PublishContext
 supabase = None
-vk = None
-uploader = None
 telegram_client = None
 
 def format_owner_id(target_id):
@@ -65,37 +175,53 @@ def format_owner_id(target_id):
         # Возвращаем строку с минусом в случае ошибки, чтобы избежать дополнительных ошибок
         return f"-{target_id}"
 
-def refresh_token_if_needed():
-    """Проверяет и обновляет токен VK API при необходимости"""
+def parse_expires_at(expires_at):
+    """Преобразует vk_targets.expires_at (ISO-строка или unix-время) в datetime, 0/None - бессрочный токен"""
+    if not expires_at:
+        return None
     try:
-        global vk
-        if not vk:
-            return True
-            
-        # Пробуем выполнить тестовый запрос
-        try:
-            vk.users.get(user_ids=[1])
-            return True
-        except Exception as e:
-            logging.warning(f"Ошибка при проверке токена: {e}")
-            
-        # Если токен недействителен, пытаемся обновить
-        try:
-            vk_session = VkApi(token=VK_API_TOKEN)
-            vk = vk_session.get_api()
-            return True
-        except Exception as e:
-            logging.error(f"Не удалось обновить токен: {e}")
+        if isinstance(expires_at, (int, float)) or str(expires_at).isdigit():
+            return datetime.datetime.fromtimestamp(int(expires_at), tz=datetime.timezone.utc)
+        parsed = datetime.datetime.fromisoformat(str(expires_at))
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+        return parsed
+    except (ValueError, TypeError, OverflowError) as e:
+        logging.warning(f"Не удалось разобрать срок действия токена {expires_at}: {e}")
+        return None
+
+def refresh_token_if_needed(settings):
+    """Проверяет, можно ли публиковать с токеном цели VK, не обращаясь к VK API
+
+    Токен непригоден, если истек его срок (vk_targets.expires_at) или VK уже отклонил
+    его с ошибкой авторизации. Повторная проверка токена выполняется только после
+    такой ошибки (см. vk_pool.call).
+    """
+    try:
+        from vk_pool import is_token_rejected
+
+        expires_at = parse_expires_at(settings.get("expires_at"))
+        if expires_at and expires_at <= datetime.datetime.now(datetime.timezone.utc):
+            logging.error(f"Срок действия токена цели VK {settings['target_id']} истек {expires_at.isoformat()}")
             return False
-            
+
+        if is_token_rejected(settings):
+            logging.error(f"Токен цели VK {settings['target_id']} отклонен VK, требуется обновить его в админке")
+            return False
+
+        return True
     except Exception as e:
-        logging.error(f"Ошибка при обновлении токена: {e}")
+        logging.error(f"Ошибка при проверке токена: {e}")
         return False
 
 def cleanup_temp_files():
-    """Очищает временную директорию от старых файлов"""
+    """Очищает временные директории от старых файлов"""
+    for files_dir in ('./files', TEMP_DIR):
+        cleanup_temp_dir(files_dir)
+
+def cleanup_temp_dir(files_dir):
+    """Удаляет из директории файлы старше одного дня"""
     try:
-        files_dir = './files'
         if not os.path.exists(files_dir):
             return
             
@@ -156,13 +282,21 @@ def check_database_structure():
 
 def init_vk():
     """Инициализирует клиент VK API"""
-    global vk, uploader
-    
     # Клиенты VK инициализируются динамически при обработке сообщений
     # Токены берутся из базы данных для каждого канала отдельно
     logging.info("VK API клиенты будут инициализированы динамически при получении сообщений")
-    vk = None
-    uploader = None
+
+def enable_local_mode():
+    """Включает работу с локальным сервером Telegram Bot API (флаг --local)"""
+    global TELEGRAM_LOCAL_MODE, MAX_VIDEO_SIZE, SCRATCH_UNKNOWN_SIZE
+    TELEGRAM_LOCAL_MODE = True
+    if not os.getenv('MAX_VIDEO_SIZE'):
+        MAX_VIDEO_SIZE = 0
+    if not os.getenv('SCRATCH_UNKNOWN_SIZE'):
+        SCRATCH_UNKNOWN_SIZE = 2000 * 1024 * 1024
+    if not TELEGRAM_API_BASE_URL:
+        logging.warning("Локальный режим включен, но не задан TELEGRAM_API_BASE_URL - используется api.telegram.org")
+    logging.info("Включен режим локального сервера Telegram Bot API")
 
 def init_telegram():
     """Функция-заглушка для совместимости с кодом"""
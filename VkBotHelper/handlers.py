@@ -1,36 +1,60 @@
 import logging
 import os
-import random
 import asyncio
-from typing import Dict, List
+import contextvars
+import inspect
+import io
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
 from datetime import datetime
 
-from telegram import Update
+from telegram import MessageOriginChannel, Update
 from telegram.ext import CallbackContext
-from vk_api import VkApi
-from vk_api.upload import VkUpload
-from PIL import Image
 
-from vk_client import edit_vk_post, get_entry, add_entry, get_source_link_for_edit
-from config import refresh_token_if_needed, format_owner_id, log_to_db
-from supabase_client import get_channel_settings_by_id
+import attachment_cache
+import channel_queue
 import config
+import media_stream
+import outbox
+import photo_transform
+import scratch_space
+import vk_batch
+import vk_pool
+from vk_client import edit_vk_post, get_entry, add_entry, get_source_link_for_edit
+from config import refresh_token_if_needed, log_to_db
+from supabase_client import get_channel_routes_by_id
+from publish_context import PublishContext
+from vk_async import VkApiError, AUTH_ERROR_CODE, photo_batches
+
+# Собираемые медиагруппы: media_group_id -> {"messages", "first_at", "last_at", "task", "job_id"}
+media_groups: Dict[str, dict] = {}
+
+# Типы вложений, которые передаются из Telegram в VK потоком, без временных файлов
+STREAM_MEDIA_TYPES = set(config.STREAM_MEDIA_TYPES)
+
+# Семафор одновременных загрузок из Telegram, создается при первом использовании
+download_semaphore = None
 
-# Константы
-MAX_VIDEO_SIZE = 100 * 1024 * 1024  # 100 МБ в байтах
+# Пул процессов для подготовки фото, создается при первом использовании
+photo_executor = None
 
-# Словарь для хранения медиагрупп
-media_groups: Dict[str, List[Update]] = {}
+# Номер попытки выполняемой задачи outbox: при повторе цели, уже получившие пост, пропускаются
+publish_attempt = contextvars.ContextVar('publish_attempt', default=1)
 
 def is_user_forward(message):
-    """Проверяет, является ли сообщение пересланным от пользователя"""
-    if hasattr(message, 'forward_from') and message.forward_from:
-        return True
-    if hasattr(message, 'forward_from_chat') and message.forward_from_chat:
-        if hasattr(message.forward_from_chat, 'type') and message.forward_from_chat.type == 'channel':
-            return False
-        return True
-    return False
+    """Проверяет, является ли сообщение пересланным от пользователя
+
+    Пропускаются пересылки от пользователей (MessageOriginUser, MessageOriginHiddenUser)
+    и из чатов (MessageOriginChat), пересылки из каналов (MessageOriginChannel) публикуются.
+    """
+    origin = message.forward_origin
+    return origin is not None and not isinstance(origin, MessageOriginChannel)
+
+async def resolve_file(file):
+    """Возвращает объект File Telegram, дожидаясь get_file(), если он еще не получен"""
+    if inspect.isawaitable(file):
+        return await file
+    return file
 
 async def download_file_with_retries(file, path, max_retries=3):
     """Загружает файл с повторами в случае ошибки"""
@@ -47,6 +71,156 @@ async def download_file_with_retries(file, path, max_retries=3):
     logging.error(f"Не удалось загрузить файл после {max_retries} попыток")
     return False
 
+async def download_to_memory_with_retries(file, max_retries=3):
+    """Загружает файл в память с повторами в случае ошибки и возвращает его содержимое"""
+    retries = 0
+    while retries < max_retries:
+        try:
+            buffer = io.BytesIO()
+            await file.download_to_memory(buffer)
+            return buffer.getvalue()
+        except Exception as e:
+            logging.error(f"Ошибка при загрузке файла в память (попытка {retries+1}/{max_retries}): {e}")
+            retries += 1
+            await asyncio.sleep(1)
+    logging.error(f"Не удалось загрузить файл после {max_retries} попыток")
+    return None
+
+async def download_media(file, name, job):
+    """Скачивает файл Telegram для загрузки в VK
+
+    Файлы до MEDIA_MEMORY_THRESHOLD байт остаются в памяти (media_stream.MemoryFile),
+    большие и файлы неизвестного размера записываются во временный файл задачи job
+    (см. scratch_space). Если квота временных файлов исчерпана, файл передается потоком.
+    """
+    if file.file_size and file.file_size <= config.MEDIA_MEMORY_THRESHOLD:
+        data = await download_to_memory_with_retries(file)
+        return media_stream.MemoryFile(name, data) if data is not None else None
+
+    if not await scratch_space.reserve(job, file.file_size):
+        logging.warning(f"Нет места для временного файла {name}, он будет передан в VK потоком")
+        return media_stream.TelegramFileSource(file.file_path, file.file_size, name)
+
+    path = scratch_space.create_file(job, name)
+    if await download_file_with_retries(file, path):
+        return path
+    scratch_space.discard(job, path)
+    return None
+
+def get_download_semaphore():
+    """Возвращает семафор, ограничивающий число одновременных загрузок из Telegram"""
+    global download_semaphore
+    if download_semaphore is None:
+        download_semaphore = asyncio.Semaphore(config.TELEGRAM_DOWNLOAD_CONCURRENCY)
+    return download_semaphore
+
+def get_photo_executor():
+    """Возвращает пул потоков, в котором фото уменьшаются и перекодируются
+
+    Pillow отпускает GIL при декодировании, масштабировании и кодировании, поэтому потоки
+    работают параллельно, а данные фото не копируются между процессами.
+    """
+    global photo_executor
+    if photo_executor is None:
+        photo_executor = ThreadPoolExecutor(max_workers=config.PHOTO_WORKERS, thread_name_prefix='photo')
+    return photo_executor
+
+async def stop_queues(application=None):
+    """Дожидается публикаций, поставленных в очереди каналов (Application.post_stop)
+
+    Вызывается до Application.shutdown(), пока HTTP-клиент бота еще открыт
+    и задачи могут скачивать файлы из Telegram.
+    """
+    await channel_queue.stop()
+
+async def shutdown(application=None):
+    """Освобождает общие ресурсы обработчиков при остановке бота (Application.post_shutdown)"""
+    global photo_executor
+    outbox.close()
+    if photo_executor is not None:
+        photo_executor.shutdown(wait=False, cancel_futures=True)
+        photo_executor = None
+    if media_stream._http is not None:
+        await media_stream._http.aclose()
+        media_stream._http = None
+    await vk_pool.close_all()
+
+async def transform_photo(source):
+    """Уменьшает и перекодирует фото в пуле потоков, чтобы не блокировать цикл событий
+
+    Временный файл пережимается на месте, файл в памяти и файл сервера Bot API
+    заменяются на MemoryFile. Потоковые источники передаются без изменений.
+    """
+    if not config.PHOTO_TRANSFORM:
+        return source
+
+    loop = asyncio.get_running_loop()
+    args = (config.PHOTO_MAX_SIDE, config.PHOTO_JPEG_QUALITY)
+    try:
+        if isinstance(source, str):
+            await loop.run_in_executor(get_photo_executor(), photo_transform.transform_file, source, *args)
+        elif isinstance(source, media_stream.MemoryFile):
+            data = await loop.run_in_executor(get_photo_executor(), photo_transform.transform_bytes, source.data, *args)
+            if data:
+                return media_stream.MemoryFile(source.name, data)
+        elif isinstance(source, media_stream.LocalFile):
+            data = await loop.run_in_executor(get_photo_executor(), photo_transform.transform_copy, source.path, *args)
+            if data:
+                return media_stream.MemoryFile(source.name, data)
+    except Exception as e:
+        logging.warning(f"Не удалось подготовить фото {source}, загружаем без изменений: {e}")
+    return source
+
+async def download_files(downloads, routes, job):
+    """Параллельно скачивает файлы из Telegram и возвращает успешно скачанные в исходном порядке
+
+    downloads - список (тип, имя файла, название, объект файла Telegram: PhotoSize, Video, Document или Audio),
+    результат - список (тип, источник, название, file_unique_id). Источник - путь к временному файлу,
+    media_stream.MemoryFile или, для типов из STREAM_MEDIA_TYPES, media_stream.TelegramFileSource.
+    Файлы, вложения которых уже есть в кэше для всех целей routes, не скачиваются (источник None).
+    Временные файлы принадлежат задаче job и удаляются вызовом scratch_space.release(job).
+    """
+    semaphore = get_download_semaphore()
+    cached = await asyncio.to_thread(
+        attachment_cache.prefetch,
+        [tg_file.file_unique_id for _, _, _, tg_file in downloads],
+        [settings.get("vk_target_id") for settings in routes]
+    )
+
+    async def download(kind, name, tg_file):
+        if tg_file.file_unique_id in cached:
+            return None
+        try:
+            file = await resolve_file(tg_file.get_file())
+        except Exception as e:
+            logging.error(f"Не удалось получить файл из Telegram: {e}")
+            return None
+
+        # Локальный сервер Bot API: файл уже лежит на диске, открываем его напрямую
+        local_path = media_stream.local_file_path(file.file_path)
+        if local_path:
+            source = media_stream.LocalFile(local_path, name)
+        elif kind in STREAM_MEDIA_TYPES:
+            return media_stream.TelegramFileSource(file.file_path, file.file_size, name)
+        else:
+            async with semaphore:
+                source = await download_media(file, name, job)
+
+        if kind == 'photo' and source:
+            source = await transform_photo(source)
+        return source
+
+    results = await asyncio.gather(*(download(kind, name, tg_file) for kind, name, _, tg_file in downloads))
+    return [
+        (kind, source, title, tg_file.file_unique_id)
+        for (kind, _, title, tg_file), source in zip(downloads, results)
+        if source or tg_file.file_unique_id in cached
+    ]
+
+def is_large_video(video):
+    """Проверяет, превышает ли видео MAX_VIDEO_SIZE (такие видео публикуются ссылкой)"""
+    return bool(config.MAX_VIDEO_SIZE) and (video.file_size or 0) > config.MAX_VIDEO_SIZE
+
 def get_source_link(message):
     """Создает ссылку на канал и сообщение для указания источника"""
     chat = message.chat if hasattr(message, 'chat') else None
@@ -68,92 +242,292 @@ def get_source_link(message):
             clean_id = clean_id[4:]
         return f'https://t.me/c/{clean_id}/{msg_id}'
 
-async def handle_media_group(update: Update, context: CallbackContext):
-    """Обрабатывает группы медиафайлов"""
+async def upload_attachment(uploader, kind, path, title):
+    """Загружает один файл в ВК и возвращает вложение в формате type{owner_id}_{id}"""
+    if kind == 'attachment':
+        # Вложение уже есть в ВК (кэш attachment_cache)
+        return path
+    elif kind == 'photo':
+        photo = (await uploader.photo_wall(path))[0]
+        return f'photo{photo["owner_id"]}_{photo["id"]}'
+    elif kind == 'video':
+        video = await uploader.video(path, name=title)
+        return f'video{video["owner_id"]}_{video["video_id"]}'
+    elif kind == 'doc':
+        doc = await uploader.document(path, title=title)
+        return f'doc{doc["doc"]["owner_id"]}_{doc["doc"]["id"]}'
+    elif kind == 'audio':
+        audio = await uploader.audio(path, title=title)
+        return f'audio{audio["owner_id"]}_{audio["id"]}'
+
+async def upload_photo_batch(uploader, upload_url, photos):
+    """Загружает группу фото одним запросом к серверу загрузки и возвращает вложения"""
+    saved = await uploader.photo_wall(photos, upload_url=upload_url)
+    return [f'photo{photo["owner_id"]}_{photo["id"]}' if photo else None for photo in saved]
+
+async def upload_single(uploader, kind, path, title):
+    """Загружает один файл и возвращает список из одного вложения"""
+    return [await upload_attachment(uploader, kind, path, title)]
+
+async def upload_attachments(uploader, media):
+    """Параллельно загружает файлы в ВК и возвращает вложения в исходном порядке media
+
+    Фото загружаются на один сервер загрузки группами по vk_async.PHOTOS_PER_UPLOAD файлов.
+    Для файлов, которые не удалось загрузить, в списке стоит None.
+    Число одновременных загрузок в цель ограничено uploader.limiter.
+    """
+    attachments = [None] * len(media)
+    # Задачи загрузки: (индексы элементов media, корутина, возвращающая их вложения)
+    jobs = []
+
+    photo_indexes = [index for index, (kind, _, _) in enumerate(media) if kind == 'photo']
+    if photo_indexes:
+        try:
+            upload_url = (await uploader.vk.photos.getWallUploadServer())['upload_url']
+        except VkApiError as e:
+            if e.code == AUTH_ERROR_CODE:
+                raise
+            logging.error(f"Не удалось получить сервер загрузки фото: {e}")
+            upload_url = None
+        except Exception as e:
+            logging.error(f"Не удалось получить сервер загрузки фото: {e}")
+            upload_url = None
+
+        if upload_url:
+            photos = [media[index][1] for index in photo_indexes]
+            for batch in photo_batches(photos):
+                indexes = [photo_indexes[position] for position in batch]
+                jobs.append((indexes, upload_photo_batch(uploader, upload_url, [media[index][1] for index in indexes])))
+
+    for index, (kind, path, title) in enumerate(media):
+        if kind != 'photo':
+            jobs.append(([index], upload_single(uploader, kind, path, title)))
+
+    async def run(job):
+        async with uploader.limiter:
+            return await job
+
+    results = await asyncio.gather(*(run(job) for _, job in jobs), return_exceptions=True)
+
+    for (indexes, _), result in zip(jobs, results):
+        if isinstance(result, VkApiError) and result.code == AUTH_ERROR_CODE:
+            # Ошибку авторизации пробрасываем, чтобы vk_pool.call проверил токен и повторил загрузку
+            raise result
+        if isinstance(result, Exception):
+            for index in indexes:
+                kind, path, _ = media[index]
+                logging.error(f"Ошибка при загрузке файла {path} ({kind}): {result}")
+            continue
+        for index, attachment in zip(indexes, result):
+            attachments[index] = attachment
+
+    return attachments
+
+def target_media(ctx, media):
+    """Подставляет в media вложения, которые уже загружены в цель VK, и убирает файлы без источника"""
+    target = []
+    for kind, source, title, file_unique_id in media:
+        attachment = attachment_cache.get(file_unique_id, ctx.vk_target_id)
+        if attachment:
+            target.append(('attachment', attachment, title, kind, file_unique_id))
+        elif source is not None:
+            target.append((kind, source, title, kind, file_unique_id))
+    return target
+
+async def publish_to_target(ctx, text, media, source_link, success_message, error_subject):
+    """Загружает вложения и публикует пост в одну цель VK из контекста публикации"""
+    if not refresh_token_if_needed(ctx.settings):
+        logging.error(f"Токен для канала ID={ctx.channel_id} и группы {ctx.target_id} недействителен")
+        return False
+
     try:
-        message = update.channel_post
-        if not message or not message.media_group_id:
-            return
-            
-        # Проверяем, является ли сообщение перепостом от пользователя
-        if is_user_forward(message):
-            logging.info("Пропуск перепоста от пользователя")
-            return
-            
-        # Добавляем сообщение в группу
-        group_id = message.media_group_id
-        if group_id not in media_groups:
-            media_groups[group_id] = []
-        media_groups[group_id].append(message)
-        
-        # Ждем остальные сообщения из группы
-        await asyncio.sleep(2)
-        
-        # Если группа уже обрабатывалась, пропускаем
-        if group_id not in media_groups:
-            return
-            
-        messages = media_groups[group_id]
-        del media_groups[group_id]
-        
-        # Получаем настройки канала
-        channel_id = message.chat.id
-        channel_username = message.chat.username
-        
-        settings = get_channel_settings_by_id(channel_id)
-        if not settings:
-            logging.info(f"Сообщение из неотслеживаемого канала: ID={channel_id}, username={channel_username}")
-            return
-            
-        config.VK_API_TOKEN = settings["access_token"]
-        config.VK_GROUP_ID = settings["target_id"]
-        post_as_group = settings.get("post_as_group", 1)
-        
-        if not refresh_token_if_needed():
-            logging.error(f"Не удалось обновить токен для канала ID={channel_id}")
-            return
+        # Файлы, уже загруженные в эту цель, не загружаются повторно
+        items = target_media(ctx, media)
+        if media and not items:
+            raise RuntimeError("Не удалось загрузить ни одного вложения")
+        upload_media = [(kind, source, title) for kind, source, title, _, _ in items]
+
+        # У каждой цели свой токен и своя keep-alive сессия из пула, без глобальных переменных
+        if config.VK_EXECUTE_BATCH:
+            # Сохранение вложений и wall.post выполняются на стороне VK одним execute
+            response, attachments = await ctx.call(lambda vk, uploader: vk_batch.publish(
+                vk, uploader, upload_media,
+                owner_id=ctx.owner_id,
+                from_group=int(bool(ctx.post_as_group)),
+                message=text,
+                copyright=source_link
+            ))
+        else:
+            attachments = await ctx.call(lambda vk, uploader: upload_attachments(uploader, upload_media))
+            if media and not any(attachments):
+                raise RuntimeError("Не удалось загрузить ни одного вложения")
+
+            response = await ctx.call(lambda vk, uploader: vk.wall.post(
+                owner_id=ctx.owner_id,
+                from_group=ctx.post_as_group,
+                message=text,
+                attachments=','.join(attachment for attachment in attachments if attachment),
+                copyright=source_link
+            ))
+
+        if response and 'post_id' in response:
+            media_records = []
+            for (_, _, _, kind, file_unique_id), attachment in zip(items, attachments):
+                if attachment:
+                    attachment_cache.remember(file_unique_id, ctx.vk_target_id, attachment)
+                    media_records.append({"file_id": file_unique_id, "file_type": kind, "vk_attachment_id": attachment})
+            await asyncio.to_thread(add_entry, ctx, response['post_id'], media_records)
+            await asyncio.to_thread(
+                log_to_db,
+                ctx.user_id,
+                "info",
+                f"{success_message} из канала {ctx.channel_name} в группу {ctx.target_name}",
+                f"Сообщение: {ctx.message_id}, Пост: {response['post_id']}"
+            )
+            return True
+    except Exception as e:
+        logging.error(f"Ошибка при публикации {error_subject} в группу {ctx.target_id}: {e}")
+        await asyncio.to_thread(
+            log_to_db,
+            ctx.user_id,
+            "error",
+            f"Ошибка при публикации {error_subject} из канала {ctx.channel_name}",
+            str(e)
+        )
+    return False
+
+def is_published(ctx):
+    """Проверяет, есть ли уже пост VK для сообщения в цели из контекста"""
+    try:
+        return get_entry(ctx) is not None
+    except KeyError:
+        return False
+
+def make_contexts(routes, message):
+    """Создает контексты публикации сообщения для каждой цели VK канала"""
+    return [
+        PublishContext(settings, message.message_id, message.chat.id, message.chat.username)
+        for settings in routes
+    ]
+
+async def publish_to_targets(routes, message, text, media, source_link, success_message, error_subject):
+    """Публикует пост во все активные цели VK канала параллельно
+
+    Файлы из media уже скачаны из Telegram один раз и используются всеми целями.
+    """
+    contexts = make_contexts(routes, message)
+    published = [False] * len(contexts)
+    if publish_attempt.get() > 1:
+        # Повтор задачи из outbox: цели, в которые пост уже опубликован, пропускаются
+        published = await asyncio.gather(*(asyncio.to_thread(is_published, ctx) for ctx in contexts))
+
+    async def publish(ctx, done):
+        if done:
+            return True
+        return await publish_to_target(ctx, text, media, source_link, success_message, error_subject)
+
+    results = await asyncio.gather(*(publish(ctx, done) for ctx, done in zip(contexts, published)))
+    if len(routes) > 1:
+        logging.info(f"Сообщение {message.message_id} опубликовано в {sum(results)} из {len(routes)} целей VK")
+    return results
+
+def get_channel_routes(message):
+    """Возвращает активные настройки кросспостинга канала, из которого пришло сообщение"""
+    channel_id = message.chat.id
+    routes = get_channel_routes_by_id(channel_id)
+    if not routes:
+        # Первое сообщение из канала уже залогировано при записи в негативный кэш
+        logging.debug(f"Сообщение из неотслеживаемого канала: ID={channel_id}, username={message.chat.username}")
+    return routes
+
+def collect_media_group(message):
+    """Добавляет часть альбома в его группу
+
+    Сообщения альбома собираются по media_group_id сразу при получении, а публикует их
+    одна задача на группу: после MEDIA_GROUP_IDLE_TIMEOUT секунд без новых частей,
+    но не позже MEDIA_GROUP_MAX_WAIT секунд после первой части.
+    Возвращает группу, если сообщение - первая часть альбома, иначе None.
+    """
+    loop = asyncio.get_running_loop()
+    group_id = message.media_group_id
+    group = media_groups.get(group_id)
+    if group is not None:
+        group["messages"].append(message)
+        group["last_at"] = loop.time()
+        return None
+
+    group = {"messages": [message], "first_at": loop.time(), "last_at": loop.time(), "task": None, "job_id": None}
+    media_groups[group_id] = group
+    group["task"] = asyncio.create_task(wait_media_group(group_id))
+    return group
+
+async def wait_media_group(group_id):
+    """Дожидается всех частей альбома, после чего группа закрывается"""
+    loop = asyncio.get_running_loop()
+    group = media_groups[group_id]
+    try:
+        while True:
+            deadline = min(
+                group["last_at"] + config.MEDIA_GROUP_IDLE_TIMEOUT,
+                group["first_at"] + config.MEDIA_GROUP_MAX_WAIT
+            )
+            delay = deadline - loop.time()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+    finally:
+        # Части, пришедшие после публикации, попадут в новую группу
+        media_groups.pop(group_id, None)
+
+async def handle_media_group(messages, routes):
+    """Обрабатывает группы медиафайлов: публикует все части альбома одним постом"""
+    try:
+        return await publish_media_group(messages, routes)
+    except Exception as e:
+        logging.error(f"Ошибка при обработке медиагруппы: {e}")
+        return False
+
+async def publish_media_group(messages, routes):
+    """Скачивает файлы альбома и публикует его во все цели VK канала, возвращает True, если все цели получили пост"""
+    message = messages[0]
+
+    downloads = []
+    text = None
+    
+    # Проверка на большие видео
+    has_large_videos = False
+    large_video_count = 0
+    
+    # Файлы скачиваются из Telegram один раз для всех целей VK
+    for index, msg in enumerate(messages):
+        if msg.caption and not text:
+            text = msg.caption
             
-        vk_session = VkApi(token=config.VK_API_TOKEN)
-        config.vk = vk_session.get_api()
-        config.uploader = VkUpload(config.vk)
-        
-        random_number = random.randint(1000000, 9999999)
-        photo_list, video_list, doc_list, audio_list = [], [], [], []
-        text = None
-        
-        # Проверка на большие видео
-        has_large_videos = False
-        large_video_count = 0
-        
-        for msg in messages:
-            if msg.caption and not text:
-                text = msg.caption
+        if msg.photo:
+            downloads.append(('photo', f'photo_{index}.jpg', None, msg.photo[-1]))
                 
-            if msg.photo:
-                path = f'./files/photo_{random_number}_{len(photo_list)}.jpg'
-                if await download_file_with_retries(msg.photo[-1].get_file(), path):
-                    photo_list.append(path)
-                    
-            elif msg.video:
-                if msg.video.file_size > MAX_VIDEO_SIZE:
-                    has_large_videos = True
-                    large_video_count += 1
-                else:
-                    path = f'./files/video_{random_number}_{len(video_list)}.mp4'
-                    if await download_file_with_retries(msg.video.get_file(), path):
-                        video_list.append(path)
-                        
-            elif msg.document:
-                path = f'./files/doc_{random_number}_{len(doc_list)}_{msg.document.file_name}'
-                if await download_file_with_retries(msg.document.get_file(), path):
-                    doc_list.append(path)
+        elif msg.video:
+            if is_large_video(msg.video):
+                has_large_videos = True
+                large_video_count += 1
+            else:
+                name = f'video_{index}.mp4'
+                downloads.append(('video', name, name, msg.video))
                     
-            elif msg.audio:
-                path = f'./files/audio_{random_number}_{len(audio_list)}.mp3'
-                if hasattr(msg.audio, 'file_name') and msg.audio.file_name:
-                    path = f'./files/audio_{random_number}_{len(audio_list)}_{msg.audio.file_name}'
-                if await download_file_with_retries(msg.audio.get_file(), path):
-                    audio_list.append(path)
+        elif msg.document:
+            name = msg.document.file_name or f'document_{index}'
+            downloads.append(('doc', name, name, msg.document))
+                
+        elif msg.audio:
+            name = f'audio_{index}.mp3'
+            if hasattr(msg.audio, 'file_name') and msg.audio.file_name:
+                name = msg.audio.file_name
+            downloads.append(('audio', name, name, msg.audio))
+
+    job = scratch_space.new_job(f"album {message.media_group_id}")
+    try:
+        # Вложения идут в том же порядке, что и сообщения альбома
+        media = await download_files(downloads, routes, job)
                     
         source_link = get_source_link(messages[0])
         post_text = text if text else ''
@@ -161,358 +535,93 @@ async def handle_media_group(update: Update, context: CallbackContext):
         if has_large_videos:
             post_text += f"\n\n{large_video_count} видео {'доступны' if large_video_count > 1 else 'доступно'} по ссылке: {source_link}"
             
-        # Загружаем файлы в ВК
-        attachments = []
-        
-        for path in photo_list:
-            try:
-                photo = config.uploader.photo_wall(path)[0]
-                attachments.append(f'photo{photo["owner_id"]}_{photo["id"]}')
-            except Exception as e:
-                logging.error(f"Ошибка при загрузке фото {path}: {e}")
-            
-        for path in video_list:
-            try:
-                video = config.uploader.video(path, name=os.path.basename(path))
-                attachments.append(f'video{video["owner_id"]}_{video["video_id"]}')
-            except Exception as e:
-                logging.error(f"Ошибка при загрузке видео {path}: {e}")
-            
-        for path in doc_list:
-            try:
-                doc = config.uploader.document(path, title=os.path.basename(path))
-                attachments.append(f'doc{doc["doc"]["owner_id"]}_{doc["doc"]["id"]}')
-            except Exception as e:
-                logging.error(f"Ошибка при загрузке документа {path}: {e}")
-            
-        for path in audio_list:
-            try:
-                audio = config.uploader.audio(path, title=os.path.basename(path))
-                attachments.append(f'audio{audio["owner_id"]}_{audio["id"]}')
-            except Exception as e:
-                logging.error(f"Ошибка при загрузке аудио {path}: {e}")
-            
-        try:
-            # Публикуем пост
-            owner_id = format_owner_id(config.VK_GROUP_ID)
-            response = await asyncio.to_thread(
-                config.vk.wall.post,
-                owner_id=owner_id,
-                from_group=post_as_group,
-                message=post_text,
-                attachments=','.join(attachments) if attachments else '',
-                copyright=source_link
-            )
-            
-            if response and 'post_id' in response:
-                add_entry(messages[0].message_id, response['post_id'], settings['user_id'])
-                log_to_db(
-                    settings['user_id'], 
-                    "info", 
-                    f"Опубликован медиа-пост из канала {channel_username or channel_id} в группу {settings.get('target_name') or config.VK_GROUP_ID}",
-                    f"Сообщение: {messages[0].message_id}, Пост: {response['post_id']}"
-                )
-        except Exception as post_error:
-            logging.error(f"Ошибка при публикации поста: {post_error}")
-            log_to_db(
-                settings['user_id'],
-                "error",
-                f"Ошибка при публикации медиа-поста из канала {channel_username or channel_id}",
-                str(post_error)
-            )
-                
+        results = await publish_to_targets(
+            routes, messages[0], post_text, media, source_link,
+            "Опубликован медиа-пост", "медиа-поста"
+        )
+        return all(results)
+    finally:
         # Удаляем временные файлы
-        for path in photo_list + video_list + doc_list + audio_list:
-            if os.path.exists(path):
-                try:
-                    os.remove(path)
-                except Exception as e:
-                    logging.error(f"Ошибка при удалении файла {path}: {e}")
-                
-    except Exception as e:
-        logging.error(f"Ошибка при обработке медиагруппы: {e}")
+        scratch_space.release(job)
 
-async def handle_photo_video(update: Update, context: CallbackContext):
+async def handle_photo_video(message, routes):
     """Обрабатывает одиночные фото или видео"""
     try:
-        message = update.channel_post
-        if not message:
-            return
-            
-        # Проверяем, является ли сообщение перепостом от пользователя
-        if is_user_forward(message):
-            logging.info("Пропуск перепоста от пользователя")
-            return
-            
-        # Проверяем, является ли сообщение частью медиагруппы
-        if hasattr(message, 'media_group_id') and message.media_group_id:
-            return  # Медиагруппы обрабатываются отдельно
-            
-        channel_id = message.chat.id
-        channel_username = message.chat.username
-        
-        settings = get_channel_settings_by_id(channel_id)
-        if not settings:
-            logging.info(f"Сообщение из неотслеживаемого канала: ID={channel_id}, username={channel_username}")
-            return
-            
-        config.VK_API_TOKEN = settings["access_token"]
-        config.VK_GROUP_ID = settings["target_id"]
-        post_as_group = settings.get("post_as_group", 1)
-        
-        if not refresh_token_if_needed():
-            logging.error(f"Не удалось обновить токен для канала ID={channel_id}")
-            return
-            
-        vk_session = VkApi(token=config.VK_API_TOKEN)
-        config.vk = vk_session.get_api()
-        config.uploader = VkUpload(config.vk)
-        
         text = message.caption if message.caption else ''
         source_link = get_source_link(message)
-        owner_id = format_owner_id(config.VK_GROUP_ID)
         
         if message.photo:
-            random_number = random.randint(1000000, 9999999)
-            path = f'./files/photo_{random_number}.jpg'
-            
-            if await download_file_with_retries(message.photo[-1].get_file(), path):
-                try:
-                    photo = config.uploader.photo_wall(path)[0]
-                    
-                    response = await asyncio.to_thread(
-                        config.vk.wall.post,
-                        owner_id=owner_id,
-                        from_group=post_as_group,
-                        message=text,
-                        attachments=f'photo{photo["owner_id"]}_{photo["id"]}',
-                        copyright=source_link
-                    )
-                    
-                    if response and 'post_id' in response:
-                        add_entry(message.message_id, response['post_id'], settings['user_id'])
-                        log_to_db(
-                            settings['user_id'], 
-                            "info", 
-                            f"Опубликовано фото из канала {channel_username or channel_id} в группу {settings.get('target_name') or config.VK_GROUP_ID}",
-                            f"Сообщение: {message.message_id}, Пост: {response['post_id']}"
-                        )
-                except Exception as e:
-                    logging.error(f"Ошибка при публикации фото: {e}")
-                    log_to_db(
-                        settings['user_id'],
-                        "error",
-                        f"Ошибка при публикации фото из канала {channel_username or channel_id}",
-                        str(e)
-                    )
-                finally:
-                    if os.path.exists(path):
-                        os.remove(path)
+            job = scratch_space.new_job(f"photo {message.message_id}")
+            try:
+                media = await download_files([('photo', 'photo.jpg', None, message.photo[-1])], routes, job)
+                if not media:
+                    return False
+                results = await publish_to_targets(
+                    routes, message, text, media, source_link,
+                    "Опубликовано фото", "фото"
+                )
+                return all(results)
+            finally:
+                scratch_space.release(job)
                 
         elif message.video:
-            if message.video.file_size > MAX_VIDEO_SIZE:
+            if is_large_video(message.video):
                 post_text = f"{text}\n\nВидео доступно по ссылке: {source_link}"
                 
+                results = await publish_to_targets(
+                    routes, message, post_text, [], source_link,
+                    "Опубликована ссылка на видео", "ссылки на видео"
+                )
+                return all(results)
+            else:
+                video_name = f"Видео {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+                job = scratch_space.new_job(f"video {message.message_id}")
                 try:
-                    response = await asyncio.to_thread(
-                        config.vk.wall.post,
-                        owner_id=owner_id,
-                        from_group=post_as_group,
-                        message=post_text,
-                        copyright=source_link
-                    )
-                    
-                    if response and 'post_id' in response:
-                        add_entry(message.message_id, response['post_id'], settings['user_id'])
-                        log_to_db(
-                            settings['user_id'], 
-                            "info", 
-                            f"Опубликована ссылка на видео из канала {channel_username or channel_id} в группу {settings.get('target_name') or config.VK_GROUP_ID}",
-                            f"Сообщение: {message.message_id}, Пост: {response['post_id']}"
-                        )
-                except Exception as e:
-                    logging.error(f"Ошибка при публикации ссылки на видео: {e}")
-                    log_to_db(
-                        settings['user_id'],
-                        "error",
-                        f"Ошибка при публикации ссылки на видео из канала {channel_username or channel_id}",
-                        str(e)
+                    media = await download_files([('video', 'video.mp4', video_name, message.video)], routes, job)
+                    if not media:
+                        return False
+                    results = await publish_to_targets(
+                        routes, message, text, media, source_link,
+                        "Опубликовано видео", "видео"
                     )
-            else:
-                random_number = random.randint(1000000, 9999999)
-                path = f'./files/video_{random_number}.mp4'
-                
-                if await download_file_with_retries(message.video.get_file(), path):
-                    try:
-                        video_name = f"Видео {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-                        video = config.uploader.video(path, name=video_name)
-                        
-                        response = await asyncio.to_thread(
-                            config.vk.wall.post,
-                            owner_id=owner_id,
-                            from_group=post_as_group,
-                            message=text,
-                            attachments=f'video{video["owner_id"]}_{video["video_id"]}',
-                            copyright=source_link
-                        )
-                        
-                        if response and 'post_id' in response:
-                            add_entry(message.message_id, response['post_id'], settings['user_id'])
-                            log_to_db(
-                                settings['user_id'], 
-                                "info", 
-                                f"Опубликовано видео из канала {channel_username or channel_id} в группу {settings.get('target_name') or config.VK_GROUP_ID}",
-                                f"Сообщение: {message.message_id}, Пост: {response['post_id']}"
-                            )
-                    except Exception as e:
-                        logging.error(f"Ошибка при публикации видео: {e}")
-                        log_to_db(
-                            settings['user_id'],
-                            "error",
-                            f"Ошибка при публикации видео из канала {channel_username or channel_id}",
-                            str(e)
-                        )
-                    finally:
-                        if os.path.exists(path):
-                            os.remove(path)
+                    return all(results)
+                finally:
+                    scratch_space.release(job)
                     
     except Exception as e:
         logging.error(f"Ошибка при обработке фото или видео: {e}")
+        return False
 
-async def handle_document(update: Update, context: CallbackContext):
-    """Обрабатывает документы - обрабатываем только избранные типы файлов"""
-    # Пропускаем стикеры, GIF и непонятные типы файлов
-    message = update.channel_post
-    if not message or not message.document:
-        return
-        
-    # Получаем MIME тип документа
-    mime_type = message.document.mime_type.lower() if message.document.mime_type else ""
-    file_name = message.document.file_name.lower() if message.document.file_name else ""
-    
-    # Пропускаем стикеры, GIF и непонятные типы файлов
-    if "image/gif" in mime_type or "tgs" in file_name or "webp" in file_name:
-        logging.info(f"Пропуск GIF/стикера/анимации: {mime_type}, {file_name}")
-        return
+async def handle_document(message, routes):
+    """Обрабатывает документы (стикеры и GIF отсеивает classify_update)"""
     try:
-        message = update.channel_post
-        if not message or not message.document:
-            return
-            
-        # Проверяем, является ли сообщение перепостом от пользователя
-        if is_user_forward(message):
-            logging.info("Пропуск перепоста от пользователя")
-            return
-            
-        # Проверяем, является ли сообщение частью медиагруппы
-        if hasattr(message, 'media_group_id') and message.media_group_id:
-            return  # Медиагруппы обрабатываются отдельно
-            
-        channel_id = message.chat.id
-        channel_username = message.chat.username
-        
-        settings = get_channel_settings_by_id(channel_id)
-        if not settings:
-            logging.info(f"Сообщение из неотслеживаемого канала: ID={channel_id}, username={channel_username}")
-            return
-            
-        config.VK_API_TOKEN = settings["access_token"]
-        config.VK_GROUP_ID = settings["target_id"]
-        post_as_group = settings.get("post_as_group", 1)
-        
-        if not refresh_token_if_needed():
-            logging.error(f"Не удалось обновить токен для канала ID={channel_id}")
-            return
-            
-        vk_session = VkApi(token=config.VK_API_TOKEN)
-        config.vk = vk_session.get_api()
-        config.uploader = VkUpload(config.vk)
-        
         text = message.caption if message.caption else ''
         source_link = get_source_link(message)
-        owner_id = format_owner_id(config.VK_GROUP_ID)
         
-        random_number = random.randint(1000000, 9999999)
-        file_name = message.document.file_name if message.document.file_name else f"document_{random_number}"
-        path = f'./files/doc_{random_number}_{file_name}'
-        
-        if await download_file_with_retries(message.document.get_file(), path):
-            try:
-                doc = config.uploader.document(path, title=file_name)
-                
-                response = await asyncio.to_thread(
-                    config.vk.wall.post,
-                    owner_id=owner_id,
-                    from_group=post_as_group,
-                    message=text,
-                    attachments=f'doc{doc["doc"]["owner_id"]}_{doc["doc"]["id"]}',
-                    copyright=source_link
-                )
-                
-                if response and 'post_id' in response:
-                    add_entry(message.message_id, response['post_id'], settings['user_id'])
-                    log_to_db(
-                        settings['user_id'], 
-                        "info", 
-                        f"Опубликован документ из канала {channel_username or channel_id} в группу {settings.get('target_name') or config.VK_GROUP_ID}",
-                        f"Сообщение: {message.message_id}, Пост: {response['post_id']}"
-                    )
-            except Exception as e:
-                logging.error(f"Ошибка при публикации документа: {e}")
-                log_to_db(
-                    settings['user_id'],
-                    "error",
-                    f"Ошибка при публикации документа из канала {channel_username or channel_id}",
-                    str(e)
-                )
-            finally:
-                if os.path.exists(path):
-                    os.remove(path)
+        file_name = message.document.file_name if message.document.file_name else f"document_{message.message_id}"
+        job = scratch_space.new_job(f"doc {message.message_id}")
+        try:
+            media = await download_files([('doc', file_name, file_name, message.document)], routes, job)
+            if not media:
+                return False
+            results = await publish_to_targets(
+                routes, message, text, media, source_link,
+                "Опубликован документ", "документа"
+            )
+            return all(results)
+        finally:
+            scratch_space.release(job)
                 
     except Exception as e:
         logging.error(f"Ошибка при обработке документа: {e}")
+        return False
 
-async def handle_audio(update: Update, context: CallbackContext):
+async def handle_audio(message, routes):
     """Обрабатывает аудиофайлы"""
     try:
-        message = update.channel_post
-        if not message or not message.audio:
-            return
-            
-        # Проверяем, является ли сообщение перепостом от пользователя
-        if is_user_forward(message):
-            logging.info("Пропуск перепоста от пользователя")
-            return
-            
-        # Проверяем, является ли сообщение частью медиагруппы
-        if hasattr(message, 'media_group_id') and message.media_group_id:
-            return  # Медиагруппы обрабатываются отдельно
-            
-        channel_id = message.chat.id
-        channel_username = message.chat.username
-        
-        settings = get_channel_settings_by_id(channel_id)
-        if not settings:
-            logging.info(f"Сообщение из неотслеживаемого канала: ID={channel_id}, username={channel_username}")
-            return
-            
-        config.VK_API_TOKEN = settings["access_token"]
-        config.VK_GROUP_ID = settings["target_id"]
-        post_as_group = settings.get("post_as_group", 1)
-        
-        if not refresh_token_if_needed():
-            logging.error(f"Не удалось обновить токен для канала ID={channel_id}")
-            return
-            
-        vk_session = VkApi(token=config.VK_API_TOKEN)
-        config.vk = vk_session.get_api()
-        config.uploader = VkUpload(config.vk)
-        
         text = message.caption if message.caption else ''
         source_link = get_source_link(message)
-        owner_id = format_owner_id(config.VK_GROUP_ID)
         
-        random_number = random.randint(1000000, 9999999)
         audio_title = ""
         
         if message.audio.title:
@@ -522,180 +631,280 @@ async def handle_audio(update: Update, context: CallbackContext):
         elif message.audio.file_name:
             audio_title = message.audio.file_name
         else:
-            audio_title = f"audio_{random_number}"
+            audio_title = f"audio_{message.message_id}"
             
-        path = f'./files/audio_{random_number}.mp3'
-        
-        if await download_file_with_retries(message.audio.get_file(), path):
-            try:
-                audio = config.uploader.audio(path, title=audio_title)
-                
-                response = await asyncio.to_thread(
-                    config.vk.wall.post,
-                    owner_id=owner_id,
-                    from_group=post_as_group,
-                    message=text,
-                    attachments=f'audio{audio["owner_id"]}_{audio["id"]}',
-                    copyright=source_link
-                )
-                
-                if response and 'post_id' in response:
-                    add_entry(message.message_id, response['post_id'], settings['user_id'])
-                    log_to_db(
-                        settings['user_id'], 
-                        "info", 
-                        f"Опубликован аудиофайл из канала {channel_username or channel_id} в группу {settings.get('target_name') or config.VK_GROUP_ID}",
-                        f"Сообщение: {message.message_id}, Пост: {response['post_id']}"
-                    )
-            except Exception as e:
-                logging.error(f"Ошибка при публикации аудио: {e}")
-                log_to_db(
-                    settings['user_id'],
-                    "error",
-                    f"Ошибка при публикации аудио из канала {channel_username or channel_id}",
-                    str(e)
-                )
-            finally:
-                if os.path.exists(path):
-                    os.remove(path)
+        job = scratch_space.new_job(f"audio {message.message_id}")
+        try:
+            media = await download_files([('audio', 'audio.mp3', audio_title, message.audio)], routes, job)
+            if not media:
+                return False
+            results = await publish_to_targets(
+                routes, message, text, media, source_link,
+                "Опубликован аудиофайл", "аудио"
+            )
+            return all(results)
+        finally:
+            scratch_space.release(job)
                 
     except Exception as e:
         logging.error(f"Ошибка при обработке аудио: {e}")
+        return False
 
-async def handle_text(update: Update, context: CallbackContext):
+async def handle_text(message, routes):
     """Обрабатывает текстовые сообщения"""
     try:
-        message = update.channel_post
-        if not message or not message.text:
-            return
-            
-        # Проверяем, является ли сообщение перепостом от пользователя
-        if is_user_forward(message):
-            logging.info("Пропуск перепоста от пользователя")
-            return
-            
-        channel_id = message.chat.id
-        channel_username = message.chat.username
-        
-        settings = get_channel_settings_by_id(channel_id)
-        if not settings:
-            logging.info(f"Сообщение из неотслеживаемого канала: ID={channel_id}, username={channel_username}")
-            return
-            
-        config.VK_API_TOKEN = settings["access_token"]
-        config.VK_GROUP_ID = settings["target_id"]
-        post_as_group = settings.get("post_as_group", 1)
-        
-        if not refresh_token_if_needed():
-            logging.error(f"Не удалось обновить токен для канала ID={channel_id}")
-            return
-            
-        vk_session = VkApi(token=config.VK_API_TOKEN)
-        config.vk = vk_session.get_api()
-        
         source_link = get_source_link(message)
-        owner_id = format_owner_id(config.VK_GROUP_ID)
         
-        try:
-            response = await asyncio.to_thread(
-                config.vk.wall.post,
-                owner_id=owner_id,
-                from_group=post_as_group,
-                message=message.text,
-                copyright=source_link
-            )
-            
-            if response and 'post_id' in response:
-                add_entry(message.message_id, response['post_id'], settings['user_id'])
-                log_to_db(
-                    settings['user_id'], 
-                    "info", 
-                    f"Опубликовано текстовое сообщение из канала {channel_username or channel_id} в группу {settings.get('target_name') or config.VK_GROUP_ID}",
-                    f"Сообщение: {message.message_id}, Пост: {response['post_id']}"
-                )
-        except Exception as e:
-            logging.error(f"Ошибка при публикации текстового сообщения: {e}")
-            log_to_db(
-                settings['user_id'],
-                "error",
-                f"Ошибка при публикации текстового сообщения из канала {channel_username or channel_id}",
-                str(e)
-            )
+        results = await publish_to_targets(
+            routes, message, message.text, [], source_link,
+            "Опубликовано текстовое сообщение", "текстового сообщения"
+        )
+        return all(results)
                 
     except Exception as e:
         logging.error(f"Ошибка при обработке текстового сообщения: {e}")
+        return False
+
+async def edit_in_target(ctx, text):
+    """Редактирует пост, соответствующий сообщению Telegram, в одной цели VK"""
+    if not refresh_token_if_needed(ctx.settings):
+        logging.error(f"Токен для канала ID={ctx.channel_id} и группы {ctx.target_id} недействителен")
+        return False
+
+    try:
+        # Находим соответствующий пост в ВК
+        post_id = await asyncio.to_thread(get_entry, ctx)
+            
+        # Редактируем пост в ВК
+        if await edit_vk_post(ctx, post_id, text):
+            logging.info(f"Успешно отредактирован пост {post_id} в ВК")
+            await asyncio.to_thread(
+                log_to_db,
+                ctx.user_id,
+                "info", 
+                f"Отредактировано сообщение из канала {ctx.channel_name} в группе {ctx.target_name}",
+                f"Сообщение: {ctx.message_id}, Пост: {post_id}"
+            )
+            return True
+
+        logging.error(f"Не удалось отредактировать пост {post_id} в ВК")
+        await asyncio.to_thread(
+            log_to_db,
+            ctx.user_id,
+            "error",
+            f"Ошибка при редактировании сообщения из канала {ctx.channel_name}",
+            f"Сообщение: {ctx.message_id}, Пост: {post_id}"
+        )
+    except KeyError:
+        # Сообщение не публиковалось в эту цель - редактировать нечего, повторять задачу незачем
+        logging.warning(f"Не найдено соответствие для сообщения {ctx.message_id} в группе {ctx.target_id}")
+        return True
+    except Exception as e:
+        logging.error(f"Ошибка при обработке редактирования: {e}")
+        await asyncio.to_thread(
+            log_to_db,
+            ctx.user_id,
+            "error",
+            f"Ошибка при обработке редактирования сообщения из канала {ctx.channel_name}",
+            str(e)
+        )
+    return False
 
-async def handle_edited_message(update: Update, context: CallbackContext):
-    """Обрабатывает отредактированные сообщения"""
+async def handle_edited_message(message, routes):
+    """Обрабатывает отредактированные сообщения (без текста их отсеивает classify_update)"""
     try:
+        text = message.text or message.caption
+
+        # Редактируем пост во всех целях VK параллельно
+        results = await asyncio.gather(*(edit_in_target(ctx, text) for ctx in make_contexts(routes, message)))
+        return all(results)
+                
+    except Exception as e:
+        logging.error(f"Ошибка при обработке отредактированного сообщения: {e}")
+        return False
+
+def classify_update(update):
+    """Определяет по обновлению канала, какой обработчик его публикует
+
+    Возвращает (вид, сообщение), где вид - ключ PIPELINES, или (None, сообщение),
+    если обновление не нужно публиковать.
+    """
+    if update.edited_channel_post:
         message = update.edited_channel_post
-        if not message:
+        if not (message.text or message.caption):
+            logging.info(f"Редактируемое сообщение не содержит текста: ID={message.message_id}")
+            return None, message
+        return 'edit', message
+
+    message = update.channel_post
+    if not message:
+        return None, None
+
+    if message.media_group_id:
+        return 'media_group', message
+    if message.photo or message.video:
+        return 'photo_video', message
+    if message.document:
+        # Пропускаем стикеры, GIF и непонятные типы файлов
+        mime_type = message.document.mime_type.lower() if message.document.mime_type else ""
+        file_name = message.document.file_name.lower() if message.document.file_name else ""
+        if "image/gif" in mime_type or "tgs" in file_name or "webp" in file_name:
+            logging.info(f"Пропуск GIF/стикера/анимации: {mime_type}, {file_name}")
+            return None, message
+        return 'document', message
+    if message.audio:
+        return 'audio', message
+    if message.text:
+        return 'text', message
+    return None, message
+
+# Обработчики по видам обновлений из classify_update (альбомы публикует handle_media_group).
+# Возвращают False, если публикация не удалась и задачу outbox нужно повторить
+PIPELINES = {
+    'photo_video': handle_photo_video,
+    'document': handle_document,
+    'audio': handle_audio,
+    'text': handle_text,
+    'edit': handle_edited_message,
+}
+
+async def process_update(kind, messages):
+    """Получает маршруты канала и передает сообщение или альбом обработчику
+
+    messages - сообщения задачи (для альбома - все части, сохраненные в outbox).
+    Возвращает False, если публикацию нужно повторить.
+    """
+    message = messages[0]
+
+    routes = await asyncio.to_thread(get_channel_routes, message)
+    if not routes:
+        return True
+
+    if kind == 'media_group':
+        return await handle_media_group(sorted(messages, key=lambda msg: msg.message_id), routes)
+    return await PIPELINES[kind](message, routes)
+
+async def renew_lease(job_id):
+    """Продлевает аренду задачи outbox, пока она выполняется"""
+    while True:
+        await asyncio.sleep(config.OUTBOX_LEASE_SECONDS / 3)
+        await asyncio.to_thread(outbox.renew, job_id)
+
+async def run_job(job_id, bot):
+    """Выполняет задачу outbox в очереди канала
+
+    Задача берется в аренду, после успешной публикации удаляется, а после неудачной
+    повторяется через outbox.retry_delay секунд первой в очереди канала. Задача, которую
+    пока нельзя взять (отложена или арендована другим процессом), откладывается до этого момента.
+    """
+    job = outbox.claim(job_id)
+    if job is None:
+        # Повтор отложен или задачу арендовал другой процесс: ставим ее в очередь снова, когда ее можно будет взять
+        job = outbox.pending_job(job_id)
+        if job is not None:
+            # Не меньше секунды, чтобы не перезапускать задачу в цикле, пока истекает чужая аренда
+            schedule_job(job_id, job["channel_id"], f"{job['kind']} (задача {job_id})", bot,
+                         max(job["ready_in"], 1), first=True)
+        return
+
+    attempt = publish_attempt.set(job["attempts"])
+    renewer = asyncio.create_task(renew_lease(job_id))
+    error = None
+    try:
+        messages = [
+            update.channel_post or update.edited_channel_post
+            for update in (Update.de_json(data, bot) for data in job["updates"])
+        ]
+        ok = await process_update(job["kind"], messages)
+    except asyncio.CancelledError:
+        # Остановка бота: задача вернется в очередь и будет выполнена при следующем запуске
+        outbox.release(job_id)
+        raise
+    except Exception as e:
+        ok, error = False, str(e)
+    finally:
+        renewer.cancel()
+        publish_attempt.reset(attempt)
+
+    if ok is not False:
+        outbox.complete(job_id)
+        return
+
+    label = f"{job['kind']} (задача {job_id})"
+    delay = outbox.fail(job_id, error or "Публикация не удалась")
+    if delay is None:
+        logging.error(f"Задача {label} не выполнена за {job['attempts']} попыток и оставлена в очереди публикаций")
+        return
+    logging.warning(f"Задача {label} будет повторена через {delay:.0f} с (попытка {job['attempts']})")
+    # Повтор остается первым в очереди канала: следующие задачи канала ждут его
+    schedule_job(job_id, job["channel_id"], label, bot, delay, first=True)
+
+def schedule_job(job_id, channel_id, label, bot, delay=0, name=None, after=None, first=False):
+    """Ставит задачу outbox в очередь канала сразу или через delay секунд
+
+    Отложенная задача сразу занимает место в очереди канала, поэтому задачи, поставленные
+    позже (например, правка того же сообщения), не выполняются раньше нее. first - место
+    в начале очереди, для повтора задачи, которая только что выполнялась.
+    after - задача asyncio (сбор альбома): выполнение начинается после ее завершения,
+    не занимая обработчик на время ожидания.
+    """
+    def factory():
+        return run_job(job_id, bot)
+
+    if after is not None:
+        resolve = channel_queue.reserve(channel_id, label, name, first)
+        after.add_done_callback(lambda task: resolve(factory))
+    elif delay or first:
+        # Задача уже записана в outbox, дожидаться ее повтора при остановке не нужно
+        resolve = channel_queue.reserve(channel_id, label, name, first, drain=False)
+        asyncio.get_running_loop().call_later(delay, resolve, factory)
+    else:
+        channel_queue.submit(channel_id, factory, label, name)
+
+async def recover_jobs(application):
+    """Возвращает в очереди каналов задачи outbox, не выполненные до остановки (Application.post_init)"""
+    jobs = await asyncio.to_thread(outbox.pending_jobs)
+    for job in jobs:
+        schedule_job(job["id"], job["channel_id"], f"{job['kind']} (задача {job['id']})", application.bot, job["ready_in"])
+    if jobs:
+        logging.info(f"Возобновлено задач из очереди публикаций: {len(jobs)}")
+    failed = await asyncio.to_thread(outbox.count, 'failed')
+    if failed:
+        logging.warning(f"В очереди публикаций задач с исчерпанными попытками: {failed}")
+
+async def route_update(update: Update, context: CallbackContext):
+    """Единственный обработчик обновлений каналов
+
+    Классифицирует обновление, один раз проверяет перепост, записывает задачу публикации
+    в outbox и ставит ее в очередь канала (channel_queue), где для нее один раз получаются
+    маршруты и вызывается ровно один обработчик из PIPELINES.
+    """
+    try:
+        kind, message = classify_update(update)
+        if not kind:
             return
-            
+
         # Проверяем, является ли сообщение перепостом от пользователя
         if is_user_forward(message):
             logging.info("Пропуск перепоста от пользователя")
             return
-            
-        channel_id = message.chat.id
-        channel_username = message.chat.username
-        message_id = message.message_id
-        
-        settings = get_channel_settings_by_id(channel_id)
-        if not settings:
-            logging.info(f"Сообщение из неотслеживаемого канала: ID={channel_id}, username={channel_username}")
-            return
-            
-        config.VK_API_TOKEN = settings["access_token"]
-        config.VK_GROUP_ID = settings["target_id"]
-        
-        if not refresh_token_if_needed():
-            logging.error(f"Не удалось обновить токен для канала ID={channel_id}")
-            return
-            
-        vk_session = VkApi(token=config.VK_API_TOKEN)
-        config.vk = vk_session.get_api()
-        
-        try:
-            # Находим соответствующий пост в ВК
-            post_id = get_entry(message_id)
-            
-            # Получаем текст из сообщения
-            if hasattr(message, 'text') and message.text:
-                text = message.text
-            elif hasattr(message, 'caption') and message.caption:
-                text = message.caption
-            else:
-                logging.info(f"Редактируемое сообщение не содержит текста: ID={message_id}")
+
+        group = None
+        if kind == 'media_group':
+            # Части альбома собираются сразу, в очередь канала встает только первая из них,
+            # остальные дописываются в ее задачу
+            group = collect_media_group(message)
+            if group is None:
+                outbox.append_update(media_groups[message.media_group_id]["job_id"], update.to_dict())
                 return
-                
-            # Редактируем пост в ВК
-            if edit_vk_post(post_id, text, message_id):
-                logging.info(f"Успешно отредактирован пост {post_id} в ВК")
-                log_to_db(
-                    settings['user_id'], 
-                    "info", 
-                    f"Отредактировано сообщение из канала {channel_username or channel_id} в группе {settings.get('target_name') or config.VK_GROUP_ID}",
-                    f"Сообщение: {message_id}, Пост: {post_id}"
-                )
-            else:
-                logging.error(f"Не удалось отредактировать пост {post_id} в ВК")
-                log_to_db(
-                    settings['user_id'],
-                    "error",
-                    f"Ошибка при редактировании сообщения из канала {channel_username or channel_id}",
-                    f"Сообщение: {message_id}, Пост: {post_id}"
-                )
-        except KeyError:
-            logging.warning(f"Не найдено соответствие для сообщения {message_id}")
-        except Exception as e:
-            logging.error(f"Ошибка при обработке редактирования: {e}")
-            log_to_db(
-                settings['user_id'],
-                "error",
-                f"Ошибка при обработке редактирования сообщения из канала {channel_username or channel_id}",
-                str(e)
-            )
-                
+
+        job_id = outbox.add(message.chat.id, kind, [update.to_dict()])
+        if group is not None:
+            group["job_id"] = job_id
+        schedule_job(
+            job_id, message.chat.id, f"{kind} {message.message_id}", context.bot,
+            name=message.chat.username, after=group["task"] if group is not None else None
+        )
+
     except Exception as e:
-        logging.error(f"Ошибка при обработке отредактированного сообщения: {e}")
+        logging.error(f"Ошибка при обработке обновления: {e}")
@@ -0,0 +1,149 @@
+import asyncio
+import io
+import logging
+import os
+import uuid
+
+import httpx
+
+import config
+
+# HTTP-клиент для чтения файлов из Telegram, создается при первом использовании
+_http = None
+
+def get_http():
+    """Возвращает общий HTTP-клиент для скачивания файлов Telegram"""
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(timeout=config.VK_HTTP_TIMEOUT)
+    return _http
+
+class MemoryFile:
+    """Небольшой файл, скачанный из Telegram в память
+
+    Каждая загрузка получает собственный поток через open(), поэтому один файл
+    можно одновременно отправлять в несколько целей VK.
+    """
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+        self.size = len(data)
+
+    def __repr__(self):
+        return f"MemoryFile({self.name}, {self.size} байт)"
+
+    def open(self):
+        """Возвращает новый поток для чтения содержимого файла"""
+        return io.BytesIO(self.data)
+
+class LocalFile:
+    """Файл в рабочем каталоге локального сервера Telegram Bot API
+
+    Открывается напрямую, без скачивания, и не удаляется после публикации:
+    файлами управляет сервер Bot API.
+    """
+
+    def __init__(self, path, name=None):
+        self.path = path
+        self.name = name or os.path.basename(path)
+
+    def __repr__(self):
+        return f"LocalFile({self.path})"
+
+    def open(self):
+        """Открывает файл для чтения"""
+        return open(self.path, 'rb')
+
+def local_file_path(file_path):
+    """Возвращает путь к файлу локального сервера Bot API в файловой системе бота или None
+
+    В режиме --local get_file возвращает путь в файловой системе сервера, его рабочий
+    каталог TELEGRAM_LOCAL_SERVER_DIR может быть смонтирован у бота как TELEGRAM_LOCAL_FILES_DIR.
+    """
+    if not config.TELEGRAM_LOCAL_MODE or not file_path:
+        return None
+
+    path = str(file_path)
+    if path.startswith('file://'):
+        path = path[len('file://'):]
+    if not os.path.isabs(path):
+        return None
+
+    if config.TELEGRAM_LOCAL_SERVER_DIR and config.TELEGRAM_LOCAL_FILES_DIR:
+        server_dir = os.path.normpath(config.TELEGRAM_LOCAL_SERVER_DIR)
+        if os.path.commonpath([server_dir, path]) == server_dir:
+            path = os.path.join(config.TELEGRAM_LOCAL_FILES_DIR, os.path.relpath(path, server_dir))
+
+    if not os.path.isfile(path):
+        logging.warning(f"Файл локального сервера Bot API не найден: {path}, он будет скачан")
+        return None
+    return path
+
+class TelegramFileSource:
+    """Файл Telegram, который передается на сервер загрузки VK потоком, без записи на диск
+
+    Источник можно читать несколько раз: каждая загрузка (в том числе в другую цель
+    или повторная после ошибки авторизации) заново открывает файл в Telegram.
+    """
+
+    def __init__(self, url, size=None, name=None):
+        self.url = url
+        self.size = size
+        self.name = name
+
+    def __repr__(self):
+        return f"TelegramFileSource({self.name})"
+
+    async def chunks(self):
+        """Читает файл из Telegram через ограниченный буфер из STREAM_BUFFER_CHUNKS блоков"""
+        queue = asyncio.Queue(maxsize=config.STREAM_BUFFER_CHUNKS)
+
+        async def produce():
+            try:
+                async with get_http().stream('GET', self.url) as response:
+                    response.raise_for_status()
+                    async for chunk in response.aiter_bytes(config.STREAM_CHUNK_SIZE):
+                        await queue.put(chunk)
+                await queue.put(None)
+            except Exception as e:
+                await queue.put(e)
+
+        producer = asyncio.create_task(produce())
+        try:
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            producer.cancel()
+
+def multipart_upload(field, source, name):
+    """Собирает multipart-запрос с одним файлом, тело которого читается из источника по мере отправки
+
+    Возвращает (заголовки, асинхронный генератор тела).
+    """
+    boundary = uuid.uuid4().hex
+    filename = name.replace('"', '%22')
+    head = (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+        f'Content-Type: application/octet-stream\r\n\r\n'
+    ).encode('utf-8')
+    tail = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+
+    headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+    if source.size:
+        # Размер известен из Telegram - сервер загрузки получает обычный запрос с Content-Length
+        headers['Content-Length'] = str(len(head) + source.size + len(tail))
+
+    async def body():
+        yield head
+        async for chunk in source.chunks():
+            yield chunk
+        yield tail
+
+    return headers, body()
@@ -0,0 +1,226 @@
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
+import config
+
+# Очередь публикаций в SQLite (OUTBOX_PATH): задача записывается при получении обновления
+# и удаляется только после успешной публикации, поэтому переживает падение процесса и ошибки VK.
+#
+# status: pending - ждет выполнения (не раньше next_attempt_at), running - выполняется
+# владельцем claimed_by до lease_until, failed - исчерпаны попытки, задача оставлена для разбора.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS publish_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    updates TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    claimed_by TEXT,
+    lease_until REAL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS publish_jobs_status ON publish_jobs (status, id);
+"""
+
+# Владелец аренды задач в этом процессе
+WORKER_ID = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+_db = None
+_lock = threading.Lock()
+
+def _connect():
+    global _db
+    if _db is None:
+        os.makedirs(os.path.dirname(config.OUTBOX_PATH) or '.', exist_ok=True)
+        _db = sqlite3.connect(config.OUTBOX_PATH, check_same_thread=False, isolation_level=None)
+        _db.row_factory = sqlite3.Row
+        # WAL и synchronous=NORMAL: запись задачи не ждет fsync и не блокирует чтение
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.executescript(SCHEMA)
+    return _db
+
+def _job(row):
+    if row is None:
+        return None
+    job = dict(row)
+    job["updates"] = json.loads(job["updates"])
+    return job
+
+def add(channel_id, kind, updates):
+    """Записывает задачу публикации и возвращает ее ID
+
+    updates - список обновлений Telegram (Update.to_dict()), для альбома дополняется
+    частями по мере их получения (append_update).
+    """
+    now = time.time()
+    with _lock:
+        cursor = _connect().execute(
+            "INSERT INTO publish_jobs (channel_id, kind, updates, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (channel_id, kind, json.dumps(updates, ensure_ascii=False), now, now)
+        )
+        return cursor.lastrowid
+
+def append_update(job_id, update):
+    """Добавляет обновление (следующую часть альбома) к задаче"""
+    with _lock:
+        db = _connect()
+        row = db.execute("SELECT updates FROM publish_jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return False
+        updates = json.loads(row["updates"])
+        updates.append(update)
+        db.execute(
+            "UPDATE publish_jobs SET updates = ?, updated_at = ? WHERE id = ?",
+            (json.dumps(updates, ensure_ascii=False), time.time(), job_id)
+        )
+        return True
+
+def claim(job_id):
+    """Берет задачу в аренду на OUTBOX_LEASE_SECONDS секунд и возвращает ее или None
+
+    Задачу нельзя взять, если она уже выполнена, отложена до next_attempt_at
+    или арендована другим обработчиком, аренда которого еще не истекла.
+    """
+    now = time.time()
+    with _lock:
+        db = _connect()
+        cursor = db.execute(
+            "UPDATE publish_jobs SET status = 'running', attempts = attempts + 1, claimed_by = ?, "
+            "lease_until = ?, updated_at = ? "
+            "WHERE id = ? AND next_attempt_at <= ? AND "
+            "(status = 'pending' OR (status = 'running' AND lease_until < ?))",
+            (WORKER_ID, now + config.OUTBOX_LEASE_SECONDS, now, job_id, now, now)
+        )
+        if not cursor.rowcount:
+            return None
+        return _job(db.execute("SELECT * FROM publish_jobs WHERE id = ?", (job_id,)).fetchone())
+
+def renew(job_id):
+    """Продлевает аренду выполняемой задачи"""
+    with _lock:
+        cursor = _connect().execute(
+            "UPDATE publish_jobs SET lease_until = ? WHERE id = ? AND status = 'running' AND claimed_by = ?",
+            (time.time() + config.OUTBOX_LEASE_SECONDS, job_id, WORKER_ID)
+        )
+        return bool(cursor.rowcount)
+
+def release(job_id):
+    """Возвращает арендованную задачу в очередь без задержки (при остановке бота)"""
+    with _lock:
+        _connect().execute(
+            "UPDATE publish_jobs SET status = 'pending', claimed_by = NULL, lease_until = NULL, updated_at = ? "
+            "WHERE id = ? AND status = 'running' AND claimed_by = ?",
+            (time.time(), job_id, WORKER_ID)
+        )
+
+def complete(job_id):
+    """Удаляет успешно выполненную задачу"""
+    with _lock:
+        _connect().execute("DELETE FROM publish_jobs WHERE id = ?", (job_id,))
+
+def retry_delay(attempts):
+    """Задержка перед следующей попыткой: экспоненциальный рост от OUTBOX_RETRY_BASE до OUTBOX_RETRY_MAX"""
+    delay = min(config.OUTBOX_RETRY_BASE * 2 ** max(attempts - 1, 0), config.OUTBOX_RETRY_MAX)
+    # Разброс, чтобы задачи, упавшие одновременно (например, при сбое VK), не повторялись все разом
+    return delay * random.uniform(0.8, 1.2)
+
+def fail(job_id, error=None):
+    """Отмечает неудачную попытку и возвращает задержку до следующей или None, если попытки исчерпаны"""
+    now = time.time()
+    with _lock:
+        db = _connect()
+        row = db.execute("SELECT attempts FROM publish_jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+
+        if row["attempts"] >= config.OUTBOX_MAX_ATTEMPTS:
+            db.execute(
+                "UPDATE publish_jobs SET status = 'failed', claimed_by = NULL, lease_until = NULL, "
+                "last_error = ?, updated_at = ? WHERE id = ?",
+                (error, now, job_id)
+            )
+            return None
+
+        delay = retry_delay(row["attempts"])
+        db.execute(
+            "UPDATE publish_jobs SET status = 'pending', next_attempt_at = ?, claimed_by = NULL, "
+            "lease_until = NULL, last_error = ?, updated_at = ? WHERE id = ?",
+            (now + delay, error, now, job_id)
+        )
+        return delay
+
+def _ready_in(job, now):
+    """Через сколько секунд задачу можно взять: после next_attempt_at и окончания чужой аренды"""
+    ready_at = job["next_attempt_at"]
+    if job["lease_until"] and job["claimed_by"] != WORKER_ID:
+        ready_at = max(ready_at, job["lease_until"])
+    return max(ready_at - now, 0)
+
+def pending_jobs():
+    """Возвращает невыполненные задачи (в том числе арендованные упавшим процессом) в порядке постановки
+
+    Для каждой задачи указано, через сколько секунд ее можно взять (ready_in).
+    """
+    now = time.time()
+    with _lock:
+        rows = _connect().execute(
+            "SELECT id, channel_id, kind, attempts, next_attempt_at, claimed_by, lease_until "
+            "FROM publish_jobs WHERE status IN ('pending', 'running') ORDER BY id"
+        ).fetchall()
+
+    jobs = []
+    for row in rows:
+        job = dict(row)
+        job["ready_in"] = _ready_in(job, now)
+        jobs.append(job)
+    return jobs
+
+def pending_job(job_id):
+    """Возвращает невыполненную задачу в формате pending_jobs или None
+
+    None - задача выполнена, исчерпала попытки или сейчас выполняется в этом процессе
+    (в очередь ее вернет тот, кто ее выполняет).
+    """
+    now = time.time()
+    with _lock:
+        row = _connect().execute(
+            "SELECT id, channel_id, kind, attempts, next_attempt_at, claimed_by, lease_until, status "
+            "FROM publish_jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+
+    if row is None or row["status"] == 'failed':
+        return None
+    if row["status"] == 'running' and row["claimed_by"] == WORKER_ID:
+        return None
+    job = dict(row)
+    job["ready_in"] = _ready_in(job, now)
+    return job
+
+def count(status=None):
+    """Сколько задач в очереди (всего или с указанным статусом)"""
+    with _lock:
+        if status:
+            row = _connect().execute("SELECT COUNT(*) FROM publish_jobs WHERE status = ?", (status,)).fetchone()
+        else:
+            row = _connect().execute("SELECT COUNT(*) FROM publish_jobs").fetchone()
+        return row[0]
+
+def close():
+    """Закрывает соединение с базой очереди"""
+    global _db
+    with _lock:
+        if _db is not None:
+            _db.close()
+            _db = None
+            logging.info("Очередь публикаций закрыта")
@@ -0,0 +1,42 @@
+import io
+import os
+
+from PIL import Image, ImageOps
+
+# Функции модуля выполняются в потоках пула (см. handlers.transform_photo) и получают
+# параметры аргументами, не обращаясь к config
+
+def _reencode(image, max_side, quality):
+    """Уменьшает изображение до max_side по большей стороне и кодирует его в JPEG"""
+    image = ImageOps.exif_transpose(image)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=quality, optimize=True, progressive=True)
+    return output.getvalue()
+
+def transform_bytes(data, max_side, quality):
+    """Возвращает пережатое изображение или None, если оно не стало меньше исходного"""
+    with Image.open(io.BytesIO(data)) as image:
+        result = _reencode(image, max_side, quality)
+    return result if len(result) < len(data) else None
+
+def transform_copy(path, max_side, quality):
+    """Пережимает изображение с диска, не изменяя файл, и возвращает результат или None"""
+    with open(path, 'rb') as f:
+        return transform_bytes(f.read(), max_side, quality)
+
+def transform_file(path, max_side, quality):
+    """Пережимает изображение на диске на месте, возвращает True, если файл уменьшился"""
+    size = os.path.getsize(path)
+    with Image.open(path) as image:
+        result = _reencode(image, max_side, quality)
+    if len(result) >= size:
+        return False
+
+    with open(path, 'wb') as f:
+        f.write(result)
+    return True
@@ -0,0 +1,54 @@
+from dataclasses import dataclass
+from typing import Optional
+
+from config import format_owner_id
+import vk_pool
+
+@dataclass
+class PublishContext:
+    """Контекст публикации одного сообщения Telegram в одну цель VK
+
+    Передается явно через обработчики, vk_client и supabase_client вместо
+    глобальных config.VK_API_TOKEN, config.VK_GROUP_ID, config.vk и config.uploader,
+    поэтому несколько публикаций могут выполняться одновременно.
+    """
+    settings: dict
+    message_id: int
+    channel_id: int
+    channel_username: Optional[str] = None
+
+    @property
+    def user_id(self):
+        return self.settings.get("user_id")
+
+    @property
+    def vk_target_id(self):
+        return self.settings.get("vk_target_id")
+
+    @property
+    def telegram_channel_id(self):
+        return self.settings.get("telegram_channel_id")
+
+    @property
+    def target_id(self):
+        return self.settings["target_id"]
+
+    @property
+    def owner_id(self):
+        return format_owner_id(self.settings["target_id"])
+
+    @property
+    def post_as_group(self):
+        return self.settings.get("post_as_group", 1)
+
+    @property
+    def target_name(self):
+        return self.settings.get("target_name") or self.settings["target_id"]
+
+    @property
+    def channel_name(self):
+        return self.channel_username or self.channel_id
+
+    async def call(self, func):
+        """Выполняет await func(vk, uploader) асинхронным клиентом цели VK из пула (см. vk_pool.call)"""
+        return await vk_pool.call(self.settings, func)
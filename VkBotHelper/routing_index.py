@@ -0,0 +1,237 @@
+import logging
+import threading
+import time
+
+import config
+
+# Индекс маршрутов: ID канала Telegram (в исходном виде и с префиксом -100) -> список настроек
+_routes = {}
+_loaded_at = 0.0
+_checked_at = 0.0
+_last_settings_update = None
+_lock = threading.Lock()
+
+# Негативный кэш: ID канала -> момент, до которого канал считается неотслеживаемым
+_untracked = {}
+
+# Каналы вместе с настройками кросспостинга и целями VK одним запросом PostgREST
+ROUTES_SELECT = (
+    "id,user_id,channel_id,channel_username,"
+    "crosspost_settings(id,vk_target_id,post_as_group,is_active,updated_at,"
+    "vk_targets(id,target_id,target_name,access_token,refresh_token,expires_at,is_active))"
+)
+
+def channel_id_variants(channel_id):
+    """Возвращает ID канала в исходном виде и в виде с/без префикса -100"""
+    str_id = str(channel_id).strip()
+    try:
+        if str_id.startswith("-100"):
+            return [int(str_id), int(str_id[4:])]
+        return [int(str_id), int(f"-100{str_id.lstrip('-')}")]
+    except (ValueError, TypeError):
+        return [channel_id]
+
+def canonical_channel_id(channel_id):
+    """Приводит ID канала к каноническому виду -100XXXXXXXXXX, в котором его присылает Telegram"""
+    variants = channel_id_variants(channel_id)
+    for variant in variants:
+        if str(variant).startswith("-100"):
+            return variant
+    return variants[0]
+
+def build_route(channel_data, settings_data, vk_data):
+    """Собирает настройки кросспостинга в формате get_channel_settings_by_id"""
+    return {
+        "user_id": channel_data["user_id"],
+        "channel_id": channel_data["channel_id"],
+        "channel_username": channel_data.get("channel_username", ""),
+        "telegram_channel_id": channel_data["id"],
+        "target_id": vk_data["target_id"],
+        "target_name": vk_data.get("target_name", ""),
+        "access_token": vk_data["access_token"],
+        "refresh_token": vk_data.get("refresh_token"),
+        "expires_at": vk_data.get("expires_at"),
+        "post_as_group": settings_data.get("post_as_group", 1),
+        "settings_id": settings_data["id"],
+        "vk_target_id": vk_data["id"]
+    }
+
+def routes_from_row(channel_data):
+    """Собирает активные маршруты из строки telegram_channels с вложенными настройками и целями"""
+    routes = []
+    settings_rows = sorted(channel_data.get("crosspost_settings") or [], key=lambda row: row["id"])
+    for settings_data in settings_rows:
+        vk_data = settings_data.get("vk_targets")
+        if not settings_data.get("is_active") or not vk_data or not vk_data.get("is_active"):
+            continue
+        routes.append(build_route(channel_data, settings_data, vk_data))
+    return routes
+
+def fetch_routes(supabase, channel_id):
+    """Получает маршруты канала из базы одним запросом с вложенными ресурсами"""
+    response = supabase.table("telegram_channels")\
+        .select(ROUTES_SELECT)\
+        .in_("channel_id", channel_id_variants(channel_id))\
+        .execute()
+
+    routes = []
+    for channel_data in response.data or []:
+        routes.extend(routes_from_row(channel_data))
+    return routes
+
+def _fetch_latest_settings_update(supabase):
+    """Получает время последнего изменения настроек кросспостинга"""
+    response = supabase.table("crosspost_settings")\
+        .select("updated_at")\
+        .order("updated_at", desc=True)\
+        .limit(1)\
+        .execute()
+    return response.data[0]["updated_at"] if response.data else None
+
+def _fetch_channels(supabase):
+    """Получает все каналы с настройками и целями постранично
+
+    PostgREST отдает не больше max-rows строк за запрос, поэтому каналы читаются
+    страницами по ROUTING_INDEX_PAGE_SIZE, пока не придет неполная страница.
+    """
+    page_size = config.ROUTING_INDEX_PAGE_SIZE
+    channels = []
+    while True:
+        response = supabase.table("telegram_channels")\
+            .select(ROUTES_SELECT)\
+            .order("id")\
+            .range(len(channels), len(channels) + page_size - 1)\
+            .execute()
+        page = response.data or []
+        channels.extend(page)
+        if len(page) < page_size:
+            return channels
+
+def _build(supabase):
+    """Загружает каналы с активными настройками и целями VK и строит новый индекс, не меняя текущий
+
+    Возвращает (индекс, последнее crosspost_settings.updated_at).
+    """
+    channels = _fetch_channels(supabase)
+
+    routes = {}
+    routes_count = 0
+    last_settings_update = None
+    for channel_data in channels:
+        for settings_data in channel_data.get("crosspost_settings") or []:
+            updated_at = settings_data.get("updated_at")
+            if updated_at and (last_settings_update is None or updated_at > last_settings_update):
+                last_settings_update = updated_at
+
+        channel_routes = routes_from_row(channel_data)
+        routes_count += len(channel_routes)
+        if not channel_routes:
+            continue
+        for key in channel_id_variants(channel_data["channel_id"]):
+            routes.setdefault(key, []).extend(channel_routes)
+
+    logging.info(f"Индекс маршрутов загружен: каналов {len(channels)}, маршрутов {routes_count}")
+    return routes, last_settings_update
+
+def _install(routes, last_settings_update):
+    """Заменяет текущий индекс построенным (вызывается под _lock)"""
+    global _routes, _loaded_at, _checked_at, _last_settings_update
+
+    now = time.monotonic()
+    _routes = routes
+    _untracked.clear()
+    _loaded_at = now
+    _checked_at = now
+    # В telegram_channels и vk_targets нет updated_at, их изменения подхватываются по TTL
+    _last_settings_update = last_settings_update
+
+def _load(supabase):
+    """Загружает каналы и заменяет индекс (вызывается под _lock)"""
+    _install(*_build(supabase))
+
+def _ensure_fresh(supabase):
+    """Перезагружает индекс по TTL или при изменении crosspost_settings.updated_at"""
+    global _checked_at
+
+    now = time.monotonic()
+    if _loaded_at and now - _checked_at < config.ROUTING_INDEX_POLL_INTERVAL:
+        return True
+
+    _checked_at = now
+    if _loaded_at and now - _loaded_at < config.ROUTING_INDEX_TTL:
+        try:
+            latest = _fetch_latest_settings_update(supabase)
+        except Exception as e:
+            logging.warning(f"Не удалось проверить изменения настроек кросспостинга: {e}")
+            return True
+
+        if latest is None or latest == _last_settings_update:
+            return True
+        logging.info("Обнаружены изменения настроек кросспостинга, перезагружаем индекс")
+
+    try:
+        _load(supabase)
+        return True
+    except Exception as e:
+        logging.error(f"Ошибка при загрузке индекса маршрутов: {e}")
+        # Продолжаем работать со старым индексом, повторим попытку при следующей проверке
+        return bool(_loaded_at)
+
+def get_routes(channel_id):
+    """Возвращает список настроек кросспостинга для канала из индекса
+
+    None означает, что индекс недоступен и нужно обращаться к базе напрямую,
+    пустой список - что канал не отслеживается.
+    """
+    supabase = config.supabase
+    if not supabase:
+        return None
+
+    with _lock:
+        if not _ensure_fresh(supabase):
+            return None
+        routes = _routes
+
+    return routes.get(channel_id_variants(channel_id)[0], [])
+
+def is_untracked(channel_id):
+    """Проверяет, записан ли канал в негативный кэш неотслеживаемых каналов"""
+    key = channel_id_variants(channel_id)[0]
+    expires_at = _untracked.get(key)
+    if expires_at is None:
+        return False
+    if expires_at < time.monotonic():
+        _untracked.pop(key, None)
+        return False
+    return True
+
+def mark_untracked(channel_id):
+    """Запоминает канал как неотслеживаемый на UNTRACKED_CHANNEL_TTL секунд"""
+    for key in channel_id_variants(channel_id):
+        _untracked[key] = time.monotonic() + config.UNTRACKED_CHANNEL_TTL
+
+def invalidate():
+    """Помечает индекс устаревшим, он будет перезагружен при следующем обращении"""
+    global _loaded_at
+    with _lock:
+        _loaded_at = 0.0
+        _untracked.clear()
+
+def reload():
+    """Сразу перезагружает индекс (используется при получении уведомления об изменениях)"""
+    supabase = config.supabase
+    if not supabase:
+        return False
+
+    # Индекс строится без блокировки, чтобы get_routes не ждал запросов к базе
+    try:
+        index = _build(supabase)
+    except Exception as e:
+        logging.error(f"Ошибка при загрузке индекса маршрутов: {e}")
+        # Старый индекс будет перезагружен при следующем обращении
+        invalidate()
+        return False
+
+    with _lock:
+        _install(*index)
+    return True
@@ -0,0 +1,164 @@
+import asyncio
+import itertools
+import logging
+import os
+import tempfile
+import time
+
+import config
+
+# Временные файлы в TEMP_DIR с квотой SCRATCH_QUOTA_BYTES: перед записью файла задача
+# (публикация одного сообщения или альбома) резервирует место, при освобождении
+# задачи ее файлы удаляются, а резерв возвращается в квоту.
+
+# Активные задачи: ID задачи -> {"bytes": зарезервировано байт, "paths": файлы задачи, "created_at"}
+_jobs = {}
+_reserved = 0
+_job_ids = itertools.count(1)
+
+# Условие ожидания свободного места и фоновая задача очистки, создаются при первом использовании
+_space_freed = None
+_sweeper = None
+
+def new_job(label=None):
+    """Создает задачу, которой будут принадлежать временные файлы"""
+    job_id = f"{next(_job_ids)}:{label}" if label else str(next(_job_ids))
+    _jobs[job_id] = {"bytes": 0, "paths": set(), "created_at": time.monotonic()}
+    _ensure_sweeper()
+    return job_id
+
+def used_bytes():
+    """Сколько байт квоты сейчас зарезервировано"""
+    return _reserved
+
+def _get_condition():
+    global _space_freed
+    if _space_freed is None:
+        _space_freed = asyncio.Condition()
+    return _space_freed
+
+async def reserve(job_id, size, timeout=None):
+    """Резервирует size байт квоты для задачи
+
+    Если места нет, ждет его освобождения не дольше timeout секунд (по умолчанию
+    SCRATCH_RESERVE_TIMEOUT) и возвращает False, если дождаться не удалось.
+    Для файла неизвестного размера (size=None) резервируется SCRATCH_UNKNOWN_SIZE байт.
+    """
+    global _reserved
+
+    size = config.SCRATCH_UNKNOWN_SIZE if size is None else max(int(size), 0)
+    if size > config.SCRATCH_QUOTA_BYTES:
+        logging.warning(f"Файл размером {size} байт больше квоты временных файлов {config.SCRATCH_QUOTA_BYTES}")
+        return False
+
+    timeout = config.SCRATCH_RESERVE_TIMEOUT if timeout is None else timeout
+    condition = _get_condition()
+    async with condition:
+        try:
+            await asyncio.wait_for(
+                condition.wait_for(lambda: _reserved + size <= config.SCRATCH_QUOTA_BYTES),
+                timeout
+            )
+        except asyncio.TimeoutError:
+            logging.warning(
+                f"Нет места для временного файла: занято {_reserved} из {config.SCRATCH_QUOTA_BYTES} байт, "
+                f"нужно {size}"
+            )
+            return False
+
+        job = _jobs.get(job_id)
+        if job is None:
+            return False
+        job["bytes"] += size
+        _reserved += size
+        return True
+
+def create_file(job_id, name):
+    """Создает пустой временный файл задачи в TEMP_DIR и возвращает путь к нему"""
+    os.makedirs(config.TEMP_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=config.TEMP_DIR, suffix=f'_{name}')
+    os.close(fd)
+    _jobs[job_id]["paths"].add(path)
+    return path
+
+def discard(job_id, path):
+    """Удаляет временный файл задачи раньше ее завершения (например, после ошибки загрузки)"""
+    job = _jobs.get(job_id)
+    if job:
+        job["paths"].discard(path)
+    _remove(path)
+
+def _remove(path):
+    if os.path.exists(path):
+        try:
+            os.remove(path)
+        except Exception as e:
+            logging.error(f"Ошибка при удалении файла {path}: {e}")
+
+def release(job_id):
+    """Удаляет файлы задачи и возвращает ее резерв в квоту"""
+    global _reserved
+
+    job = _jobs.pop(job_id, None)
+    if job is None:
+        return
+    for path in job["paths"]:
+        _remove(path)
+    _reserved -= job["bytes"]
+
+    if job["bytes"] and _space_freed is not None:
+        try:
+            asyncio.get_running_loop().create_task(_notify())
+        except RuntimeError:
+            pass
+
+async def _notify():
+    condition = _get_condition()
+    async with condition:
+        condition.notify_all()
+
+def sweep():
+    """Удаляет из TEMP_DIR файлы, которые не принадлежат ни одной задаче и старше SCRATCH_ORPHAN_TTL"""
+    owned = set()
+    now = time.monotonic()
+    for job_id, job in _jobs.items():
+        owned.update(job["paths"])
+        if now - job["created_at"] > config.SCRATCH_ORPHAN_TTL:
+            logging.warning(f"Задача {job_id} держит временные файлы дольше {config.SCRATCH_ORPHAN_TTL} секунд")
+
+    removed = 0
+    if os.path.isdir(config.TEMP_DIR):
+        for filename in os.listdir(config.TEMP_DIR):
+            path = os.path.join(config.TEMP_DIR, filename)
+            if path in owned or not os.path.isfile(path):
+                continue
+            try:
+                if time.time() - os.path.getmtime(path) > config.SCRATCH_ORPHAN_TTL:
+                    os.remove(path)
+                    removed += 1
+            except Exception as e:
+                logging.error(f"Не удалось удалить временный файл {filename}: {e}")
+
+    if removed:
+        logging.info(f"Удалено осиротевших временных файлов: {removed}")
+    return removed
+
+async def _sweep_loop():
+    while True:
+        await asyncio.sleep(config.SCRATCH_SWEEP_INTERVAL)
+        try:
+            # В цикле событий, а не в потоке: sweep читает _jobs, которые меняют обработчики
+            sweep()
+        except Exception as e:
+            logging.error(f"Ошибка при очистке временных файлов: {e}")
+
+def _ensure_sweeper():
+    """Запускает фоновую очистку TEMP_DIR в текущем цикле событий"""
+    global _sweeper
+    if _sweeper is not None and not _sweeper.done():
+        return
+    try:
+        _sweeper = asyncio.get_running_loop().create_task(_sweep_loop())
+    except RuntimeError:
+        # Нет запущенного цикла событий - очистка запустится при следующей задаче
+        _sweeper = None
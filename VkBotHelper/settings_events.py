@@ -0,0 +1,42 @@
+import json
+import logging
+import socket
+import threading
+
+import config
+import routing_index
+
+def notify_settings_changed(table, row_id=None):
+    """Отправляет процессу бота уведомление об изменении настроек кросспостинга"""
+    try:
+        payload = json.dumps({"table": table, "id": row_id}).encode('utf-8')
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(payload, (config.SETTINGS_EVENTS_HOST, config.SETTINGS_EVENTS_PORT))
+    except Exception as e:
+        # Бот все равно подхватит изменения по TTL индекса
+        logging.warning(f"Не удалось отправить уведомление об изменении настроек: {e}")
+
+def _listen(sock):
+    """Принимает уведомления и перезагружает индекс маршрутов"""
+    while True:
+        try:
+            data, _ = sock.recvfrom(65535)
+            event = json.loads(data.decode('utf-8'))
+            logging.info(f"Получено уведомление об изменении настроек: {event}")
+            routing_index.reload()
+        except Exception as e:
+            logging.error(f"Ошибка при обработке уведомления об изменении настроек: {e}")
+
+def start_settings_listener():
+    """Запускает фоновый поток, принимающий уведомления об изменении настроек"""
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((config.SETTINGS_EVENTS_HOST, config.SETTINGS_EVENTS_PORT))
+    except Exception as e:
+        logging.warning(f"Не удалось запустить прием уведомлений об изменении настроек: {e}")
+        return False
+
+    thread = threading.Thread(target=_listen, args=(sock,), daemon=True)
+    thread.start()
+    logging.info(f"Ожидаем уведомления об изменении настроек на {config.SETTINGS_EVENTS_HOST}:{config.SETTINGS_EVENTS_PORT}")
+    return True
@@ -2,90 +2,60 @@ import logging
 from config import supabase
 from datetime import datetime
 
-def get_channel_settings_by_id(channel_id):
-    """Получает настройки для канала по его ID"""
+import config
+import routing_index
+from settings_events import notify_settings_changed
+
+def get_channel_routes_by_id(channel_id):
+    """Получает все активные настройки кросспостинга (по одной на цель VK) для канала по его ID"""
     try:
+        # Канал недавно уже искали и не нашли - не обращаемся ни к индексу, ни к базе
+        if routing_index.is_untracked(channel_id):
+            return []
+
         logging.debug(f"Поиск канала с исходным ID: {channel_id}")
 
+        # Сначала ищем в индексе маршрутов, обращение к базе не требуется
+        routes = routing_index.get_routes(channel_id)
+        if routes is not None:
+            if not routes:
+                routing_index.mark_untracked(channel_id)
+                logging.info(f"Канал с ID {channel_id} не отслеживается, его сообщения будут пропускаться")
+            return routes
+
+        supabase = config.supabase
         if not supabase:
             logging.error("Отсутствует соединение с Supabase")
-            return None
-
-        # Логируем все каналы в базе для отладки
-        all_channels = supabase.table("telegram_channels").select("*").execute()
-        logging.debug(f"Все каналы в базе: {all_channels.data}")
-
-        # Ищем канал по исходному ID
-        channel_response = supabase.table("telegram_channels").select("id,user_id,channel_id,channel_username").eq("channel_id", channel_id).execute()
-
-        if not channel_response.data or len(channel_response.data) == 0:
-            # Пробуем преобразовать ID
-            if str(channel_id).startswith("-100"):
-                converted_id = int(str(channel_id)[4:])
-                logging.debug(f"Пробуем преобразованный ID без префикса: {converted_id}")
-                channel_response = supabase.table("telegram_channels").select("id,user_id,channel_id,channel_username").eq("channel_id", converted_id).execute()
-            else:
-                converted_id = int(f"-100{channel_id}")
-                logging.debug(f"Пробуем преобразованный ID с префиксом: {converted_id}")
-                channel_response = supabase.table("telegram_channels").select("id,user_id,channel_id,channel_username").eq("channel_id", converted_id).execute()
-
-        if not channel_response.data or len(channel_response.data) == 0:
-            logging.info(f"Канал с ID {channel_id} не найден после всех проверок")
-            return None
-
-        channel_data = channel_response.data[0]
-        logging.debug(f"Найден канал: {channel_data}")
-
-        # Получаем настройки кросспостинга
-        settings_response = supabase.table("crosspost_settings")\
-            .select("id,vk_target_id,post_as_group")\
-            .eq("telegram_channel_id", channel_data["id"])\
-            .eq("is_active", True)\
-            .execute()
-
-        if not settings_response.data or len(settings_response.data) == 0:
-            logging.info(f"Настройки кросспостинга для канала ID {channel_id} не найдены")
-            return None
-
-        settings_data = settings_response.data[0]
-
-        # Получаем информацию о цели VK
-        vk_response = supabase.table("vk_targets")\
-            .select("id,target_id,target_name,access_token,refresh_token,expires_at")\
-            .eq("id", settings_data["vk_target_id"])\
-            .eq("is_active", True)\
-            .execute()
+            return []
 
-        if not vk_response.data or len(vk_response.data) == 0:
-            logging.info(f"Цель VK для канала ID {channel_id} не найдена или не активна")
-            continue
-
-        vk_data = vk_response.data[0]
-
-        # Формируем настройки с полными данными
-        return {
-            "user_id": channel_data["user_id"],
-            "channel_id": channel_data["channel_id"],
-            "channel_username": channel_data.get("channel_username", ""),
-            "target_id": vk_data["target_id"],
-            "target_name": vk_data.get("target_name", ""),
-            "access_token": vk_data["access_token"],
-            "refresh_token": vk_data.get("refresh_token"),
-            "expires_at": vk_data.get("expires_at"),
-            "post_as_group": settings_data.get("post_as_group", 1),
-            "settings_id": settings_data["id"],
-            "vk_target_id": vk_data["id"]
-        }
+        # Канал, его настройки и цели VK одним запросом (по обоим вариантам ID)
+        routes = routing_index.fetch_routes(supabase, channel_id)
+        if not routes:
+            routing_index.mark_untracked(channel_id)
+            logging.info(f"Канал с ID {channel_id} не найден или для него нет активных настроек кросспостинга")
 
-        logging.info(f"Канал с ID {channel_id} не найден после всех проверок")
-        return None
+        return routes
     except Exception as e:
         logging.error(f"Ошибка при получении настроек канала с ID {channel_id}: {e}")
-        return None
+        return []
 
-def log_post(user_id, message_id, post_id):
-    """Логирует информацию о кросспостинге в базу данных"""
+def get_channel_settings_by_id(channel_id):
+    """Получает настройки для канала по его ID (первая активная цель VK)"""
+    routes = get_channel_routes_by_id(channel_id)
+    return routes[0] if routes else None
+
+def log_post(ctx, post_id, media=None):
+    """Логирует информацию о кросспостинге в базу данных (отдельная запись для каждой цели VK)
+
+    ctx - PublishContext с сообщением Telegram, пользователем и целью VK,
+    media - вложения поста для post_media, по ним работает attachment_cache.
+    """
+    user_id = ctx.user_id
+    message_id = ctx.message_id
+    vk_target_id = ctx.vk_target_id
+    telegram_channel_id = ctx.telegram_channel_id
     try:
+        supabase = config.supabase
         if not supabase:
             logging.error("Отсутствует соединение с Supabase")
             # Запись в файл как запасной вариант
@@ -93,19 +63,25 @@ def log_post(user_id, message_id, post_id):
                 f.write(f'{message_id}:{post_id}\n')
             return False
 
-        # Проверяем, существует ли уже запись для этого сообщения
-        check_response = supabase.table("post_info").select("id").eq("telegram_message_id", message_id).execute()
+        # Проверяем, существует ли уже запись для этого сообщения, канала и цели VK
+        # (ID сообщений Telegram уникальны только в пределах канала)
+        check_query = supabase.table("post_info").select("id").eq("telegram_message_id", message_id)
+        if vk_target_id:
+            check_query = check_query.eq("vk_target_id", vk_target_id)
+        if telegram_channel_id:
+            check_query = check_query.eq("telegram_channel_id", telegram_channel_id)
+        check_response = check_query.execute()
 
         if check_response.data and len(check_response.data) > 0:
             logging.info(f"Запись для сообщения {message_id} уже существует, обновляем")
 
+            post_info_id = check_response.data[0]["id"]
+
             # Обновляем запись
             update_response = supabase.table("post_info").update({
                 "vk_post_id": post_id,
                 "updated_at": "now()"
-            }).eq("telegram_message_id", message_id).execute()
-
-            post_info_id = check_response.data[0]["id"]
+            }).eq("id", post_info_id).execute()
         else:
             # Создаем новую запись в post_info
             new_post_info = {
@@ -121,6 +97,12 @@ def log_post(user_id, message_id, post_id):
             if user_id:
                 new_post_info["user_id"] = user_id
 
+            if vk_target_id:
+                new_post_info["vk_target_id"] = vk_target_id
+
+            if telegram_channel_id:
+                new_post_info["telegram_channel_id"] = telegram_channel_id
+
             post_info_response = supabase.table("post_info").insert(new_post_info).execute()
 
             if post_info_response.data and len(post_info_response.data) > 0:
@@ -140,6 +122,12 @@ def log_post(user_id, message_id, post_id):
         if user_id:
             new_post["user_id"] = user_id
 
+        if vk_target_id:
+            new_post["vk_target_id"] = vk_target_id
+
+        if telegram_channel_id:
+            new_post["telegram_channel_id"] = telegram_channel_id
+
         post_response = supabase.table("posts").insert(new_post).execute()
 
         if post_response.data and len(post_response.data) > 0:
@@ -178,7 +166,15 @@ def log_post(user_id, message_id, post_id):
 
         supabase.table("post_content").insert(content_data).execute()
 
-        logging.info(f"Успешно сохранена информация о посте {message_id} -> {post_id}")
+        # Сохраняем вложения поста: file_id - file_unique_id файла Telegram, vk_attachment_id - вложение VK
+        if media:
+            media_rows = [
+                {**item, "post_id": post_id_db, "processed": True, "created_at": "now()"}
+                for item in media
+            ]
+            supabase.table("post_media").insert(media_rows).execute()
+
+        logging.info(f"Успешно сохранена информация о посте {message_id} -> {post_id} (цель VK {vk_target_id})")
         return True
     except Exception as e:
         logging.error(f"Ошибка при сохранении информации о посте: {e}")
@@ -246,12 +242,25 @@ def add_channel(user_id, channel_id, channel_title, channel_username):
             logging.error("Отсутствует соединение с Supabase")
             return None
 
-        # Проверяем, существует ли уже канал с таким ID
-        check_response = supabase.table("telegram_channels").select("id").eq("channel_id", channel_id).execute()
+        # Храним ID канала в каноническом виде -100XXXXXXXXXX
+        channel_id = routing_index.canonical_channel_id(channel_id)
+
+        # Проверяем, существует ли уже канал с таким ID (в том числе записанный без префикса)
+        check_response = supabase.table("telegram_channels")\
+            .select("id,channel_id")\
+            .in_("channel_id", routing_index.channel_id_variants(channel_id))\
+            .execute()
 
         if check_response.data and len(check_response.data) > 0:
             logging.info(f"Канал с ID {channel_id} уже существует")
-            return check_response.data[0]["id"]
+            existing = check_response.data[0]
+
+            # Приводим ранее сохраненный ID к каноническому виду
+            if existing["channel_id"] != channel_id:
+                supabase.table("telegram_channels").update({"channel_id": channel_id}).eq("id", existing["id"]).execute()
+                notify_settings_changed("telegram_channels", existing["id"])
+
+            return existing["id"]
 
         # Создаем новый канал
         channel_data = {
@@ -266,6 +275,7 @@ def add_channel(user_id, channel_id, channel_title, channel_username):
         response = supabase.table("telegram_channels").insert(channel_data).execute()
 
         if response.data and len(response.data) > 0:
+            notify_settings_changed("telegram_channels", response.data[0]["id"])
             return response.data[0]["id"]
         else:
             logging.error("Не удалось добавить канал")
@@ -300,6 +310,7 @@ def add_vk_target(user_id, target_id, target_name, access_token, refresh_token=N
                 update_data["expires_at"] = expires_at
 
             supabase.table("vk_targets").update(update_data).eq("id", check_response.data[0]["id"]).execute()
+            notify_settings_changed("vk_targets", check_response.data[0]["id"])
             return check_response.data[0]["id"]
 
         # Создаем новую цель
@@ -322,6 +333,7 @@ def add_vk_target(user_id, target_id, target_name, access_token, refresh_token=N
         response = supabase.table("vk_targets").insert(target_data).execute()
 
         if response.data and len(response.data) > 0:
+            notify_settings_changed("vk_targets", response.data[0]["id"])
             return response.data[0]["id"]
         else:
             logging.error("Не удалось добавить цель VK")
@@ -354,6 +366,7 @@ def add_crosspost_setting(user_id, telegram_channel_id, vk_target_id, post_as_gr
                 "updated_at": "now()"
             }).eq("id", check_response.data[0]["id"]).execute()
 
+            notify_settings_changed("crosspost_settings", check_response.data[0]["id"])
             return check_response.data[0]["id"]
 
         # Создаем новую настройку
@@ -370,6 +383,7 @@ def add_crosspost_setting(user_id, telegram_channel_id, vk_target_id, post_as_gr
         response = supabase.table("crosspost_settings").insert(setting_data).execute()
 
         if response.data and len(response.data) > 0:
+            notify_settings_changed("crosspost_settings", response.data[0]["id"])
             return response.data[0]["id"]
         else:
             logging.error("Не удалось добавить настройку кросспостинга")
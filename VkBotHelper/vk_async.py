@@ -0,0 +1,237 @@
+import asyncio
+import logging
+import os
+import time
+
+import httpx
+
+import config
+from media_stream import LocalFile, MemoryFile, TelegramFileSource, multipart_upload
+
+# Коды ошибок VK API
+AUTH_ERROR_CODE = 5
+TOO_MANY_RPS_CODE = 6
+
+# Сколько фото сервер загрузки VK принимает одним запросом (поля file1..file5)
+PHOTOS_PER_UPLOAD = 5
+
+class VkApiError(Exception):
+    """Ошибка, которую вернул VK API"""
+
+    def __init__(self, method, error):
+        super().__init__(f"[{error.get('error_code')}] {error.get('error_msg')}")
+        self.method = method
+        self.code = error.get('error_code')
+        self.error = error
+
+class VkUploadError(Exception):
+    """Ошибка сервера загрузки VK"""
+
+def _prepare_params(params):
+    """Приводит параметры к виду, который принимает VK API"""
+    prepared = {}
+    for key, value in params.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            value = int(value)
+        elif isinstance(value, (list, tuple)):
+            value = ','.join(str(item) for item in value)
+        prepared[key] = value
+    return prepared
+
+class _MethodGroup:
+    """Позволяет вызывать методы как vk.wall.post(...)"""
+
+    def __init__(self, vk, name):
+        self._vk = vk
+        self._name = name
+
+    def __getattr__(self, method):
+        async def call(**params):
+            return await self._vk.method(f'{self._name}.{method}', **params)
+        return call
+
+class AsyncVkApi:
+    """Асинхронный клиент VK API на httpx с тем же интерфейсом vk.<группа>.<метод>, что и у vk_api"""
+
+    def __init__(self, token, http=None, api_version=None):
+        self.token = token
+        self.api_version = api_version or config.VK_API_VERSION
+        self.http = http or httpx.AsyncClient(timeout=config.VK_HTTP_TIMEOUT)
+        # Не больше VK_API_RPS запросов в секунду на токен, как в vk_api
+        self._rps_delay = 1.0 / config.VK_API_RPS
+        self._rps_lock = asyncio.Lock()
+        self._last_request = 0.0
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return _MethodGroup(self, name)
+
+    async def _wait_rps(self):
+        """Выдерживает паузу между запросами к VK API"""
+        async with self._rps_lock:
+            delay = self._rps_delay - (time.monotonic() - self._last_request)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._last_request = time.monotonic()
+
+    async def method(self, method, **params):
+        """Вызывает метод VK API и возвращает поле response"""
+        values = _prepare_params(params)
+        values['v'] = self.api_version
+        values['access_token'] = self.token
+
+        for attempt in range(3):
+            await self._wait_rps()
+            response = await self.http.post(f'{config.VK_API_URL}/{method}', data=values)
+            response.raise_for_status()
+            data = response.json()
+
+            if 'error' not in data:
+                return data['response']
+
+            error = VkApiError(method, data['error'])
+            if error.code == TOO_MANY_RPS_CODE and attempt < 2:
+                logging.warning(f"Слишком много запросов к VK API ({method}), повторяем")
+                await asyncio.sleep(self._rps_delay * (attempt + 2))
+                continue
+            raise error
+
+    async def aclose(self):
+        """Закрывает HTTP-клиент"""
+        await self.http.aclose()
+
+def _open_file(file, default_name):
+    """Возвращает (имя, file-like объект, нужно_ли_закрыть) для пути, file-like объекта, файла в памяти или файла сервера Bot API"""
+    if isinstance(file, (MemoryFile, LocalFile)):
+        return file.name or default_name, file.open(), True
+    if hasattr(file, 'read'):
+        name = os.path.basename(getattr(file, 'name', '') or '') or default_name
+        return name, file, False
+    return os.path.basename(file), open(file, 'rb'), True
+
+def photo_batches(photos):
+    """Разбивает фото на группы индексов для загрузки по PHOTOS_PER_UPLOAD в одном запросе
+
+    Потоковые источники (media_stream.TelegramFileSource) загружаются по одному.
+    """
+    batches = []
+    batch = []
+    for index, photo in enumerate(photos):
+        if isinstance(photo, TelegramFileSource):
+            batches.append([index])
+            continue
+        batch.append(index)
+        if len(batch) == PHOTOS_PER_UPLOAD:
+            batches.append(batch)
+            batch = []
+    if batch:
+        batches.append(batch)
+    return sorted(batches)
+
+class AsyncVkUpload:
+    """Асинхронная загрузка файлов в VK с тем же интерфейсом, что и vk_api.upload.VkUpload"""
+
+    def __init__(self, vk):
+        self.vk = vk
+        self.http = vk.http
+        # Ограничитель одновременных загрузок в одну цель VK (клиент в пуле свой у каждой цели)
+        self.limiter = asyncio.Semaphore(config.VK_UPLOAD_CONCURRENCY)
+
+    async def post_file(self, url, field, file, default_name):
+        """Отправляет файл на сервер загрузки VK и возвращает его ответ"""
+        if isinstance(file, TelegramFileSource):
+            # Файл передается из Telegram потоком, без записи на диск
+            headers, body = multipart_upload(field, file, file.name or default_name)
+            response = await self.http.post(url, content=body, headers=headers)
+            return self._upload_response(response)
+        return await self.post_files(url, [(field, file, default_name)])
+
+    async def post_files(self, url, files):
+        """Отправляет несколько файлов одним multipart-запросом, files - список (поле, файл, имя по умолчанию)"""
+        opened = []
+        try:
+            for field, file, default_name in files:
+                name, fileobj, should_close = _open_file(file, default_name)
+                opened.append((field, name, fileobj, should_close))
+            response = await self.http.post(url, files=[
+                (field, (name, fileobj)) for field, name, fileobj, _ in opened
+            ])
+        finally:
+            for _, _, fileobj, should_close in opened:
+                if should_close:
+                    fileobj.close()
+        return self._upload_response(response)
+
+    def _upload_response(self, response):
+        """Проверяет ответ сервера загрузки VK"""
+        response.raise_for_status()
+        data = response.json()
+        if 'error' in data:
+            raise VkUploadError(f"Ошибка сервера загрузки VK: {data['error']}")
+        return data
+
+    async def upload_wall_photos(self, upload_url, photos):
+        """Отправляет до PHOTOS_PER_UPLOAD фото одним запросом и возвращает ответ сервера загрузки"""
+        if len(photos) == 1:
+            uploaded = await self.post_file(upload_url, 'photo', photos[0], 'photo.jpg')
+        else:
+            uploaded = await self.post_files(upload_url, [
+                (f'file{number}', photo, f'file{number}.jpg') for number, photo in enumerate(photos, 1)
+            ])
+        if not uploaded.get('photo') or uploaded['photo'] == '[]':
+            raise VkUploadError("Сервер загрузки VK не принял фото")
+        return uploaded
+
+    async def photo_wall(self, photos, user_id=None, group_id=None, caption=None, upload_url=None):
+        """Загрузка изображений на стену пользователя или в группу
+
+        Фото отправляются на один сервер загрузки (upload_url, если он уже получен) группами
+        по PHOTOS_PER_UPLOAD файлов, на каждую группу - один вызов saveWallPhoto.
+        """
+        values = {}
+        if user_id:
+            values['user_id'] = user_id
+        elif group_id:
+            values['group_id'] = group_id
+        if caption:
+            values['caption'] = caption
+
+        if not isinstance(photos, list):
+            photos = [photos]
+        if not upload_url:
+            upload_url = (await self.vk.photos.getWallUploadServer(**values))['upload_url']
+
+        saved = [None] * len(photos)
+        for batch in photo_batches(photos):
+            uploaded = await self.upload_wall_photos(upload_url, [photos[index] for index in batch])
+            response = await self.vk.photos.saveWallPhoto(**values, **uploaded)
+            for index, photo in zip(batch, response):
+                saved[index] = photo
+        return saved
+
+    async def video(self, video_file, name=None, description=None, group_id=None, **params):
+        """Загрузка видео"""
+        response = await self.vk.video.save(name=name, description=description, group_id=group_id, **params)
+        url = response.pop('upload_url')
+        response.update(await self.post_file(url, 'video_file', video_file, 'video.mp4'))
+        return response
+
+    async def document(self, doc, title=None, tags=None, group_id=None, to_wall=False):
+        """Загрузка документа"""
+        if to_wall:
+            server = await self.vk.docs.getWallUploadServer(group_id=group_id)
+        else:
+            server = await self.vk.docs.getUploadServer(group_id=group_id)
+
+        uploaded = await self.post_file(server['upload_url'], 'file', doc, 'document')
+        return await self.vk.docs.save(file=uploaded['file'], title=title, tags=tags)
+
+    async def audio(self, audio, artist=None, title=None):
+        """Загрузка аудио"""
+        server = await self.vk.audio.getUploadServer()
+        uploaded = await self.post_file(server['upload_url'], 'file', audio, 'audio.mp3')
+        uploaded.update({'artist': artist, 'title': title})
+        return await self.vk.audio.save(**uploaded)
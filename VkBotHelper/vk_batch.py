@@ -0,0 +1,167 @@
+import asyncio
+import json
+import logging
+
+from vk_async import VkApiError, AUTH_ERROR_CODE, photo_batches
+
+# Пакетная публикация через метод execute (VKScript):
+#   1. один execute получает адреса серверов загрузки (и вызывает video.save для каждого видео);
+#   2. файлы отправляются на серверы загрузки (это не вызовы API);
+#   3. второй execute сохраняет фото, документы и аудио и публикует пост.
+# Вместо ~2N+1 вызовов API на альбом получается 2, фото отправляются по 5 в одном запросе.
+
+# Поле файла и имя по умолчанию для серверов загрузки
+_UPLOAD_FIELDS = {
+    'video': ('video_file', 'video.mp4'),
+    'doc': ('file', 'document'),
+    'audio': ('file', 'audio.mp3'),
+}
+
+def _literal(value):
+    """Преобразует значение Python в литерал VKScript"""
+    return json.dumps(value, ensure_ascii=False)
+
+def _build_servers_script(media):
+    """Скрипт, получающий адреса серверов загрузки для всех типов вложений поста"""
+    kinds = {kind for kind, _, _ in media}
+    lines = []
+    result = []
+
+    if 'photo' in kinds:
+        result.append('"photo": API.photos.getWallUploadServer({}).upload_url')
+    if 'doc' in kinds:
+        result.append('"doc": API.docs.getUploadServer({}).upload_url')
+    if 'audio' in kinds:
+        result.append('"audio": API.audio.getUploadServer({}).upload_url')
+
+    videos = []
+    for index, (kind, _, title) in enumerate(media):
+        if kind == 'video':
+            lines.append(f'var v{index} = API.video.save({_literal({"name": title})});')
+            videos.append(f'"{index}": v{index}')
+    if videos:
+        result.append('"videos": {' + ', '.join(videos) + '}')
+
+    lines.append('return {' + ', '.join(result) + '};')
+    return '\n'.join(lines)
+
+def _build_post_script(items, photo_uploads, post_params):
+    """Скрипт, сохраняющий загруженные файлы и публикующий пост
+
+    items - список (тип, данные) в порядке вложений: для видео и уже известных вложений
+    данные - готовое вложение, для фото - (номер запроса в photo_uploads, позиция в нем),
+    для остальных типов - ответ сервера загрузки, для файлов, которые не удалось загрузить, - (None, None).
+    photo_uploads - ответы сервера загрузки фото, на каждый - один вызов saveWallPhoto.
+    """
+    lines = ['var att = "";', 'var sep = "";']
+
+    for number, data in enumerate(photo_uploads):
+        lines.append(f'var p{number} = API.photos.saveWallPhoto({_literal(data)});')
+
+    for index, (kind, data) in enumerate(items):
+        lines.append(f'var a{index} = "";')
+        if kind in ('video', 'attachment'):
+            lines.append(f'a{index} = {_literal(data)};')
+        elif kind == 'photo':
+            number, position = data
+            lines.append(f'if (p{number} && p{number}.length > {position}) {{ a{index} = "photo" + p{number}[{position}].owner_id + "_" + p{number}[{position}].id; }}')
+        elif kind == 'doc':
+            lines.append(f'var s{index} = API.docs.save({_literal(data)});')
+            lines.append(f'if (s{index}) {{ a{index} = "doc" + s{index}.doc.owner_id + "_" + s{index}.doc.id; }}')
+        elif kind == 'audio':
+            lines.append(f'var s{index} = API.audio.save({_literal(data)});')
+            lines.append(f'if (s{index}) {{ a{index} = "audio" + s{index}.owner_id + "_" + s{index}.id; }}')
+        lines.append(f'if (a{index} != "") {{ att = att + sep + a{index}; sep = ","; }}')
+
+    result_items = '[' + ', '.join(f'a{index}' for index in range(len(items))) + ']'
+    if items:
+        # Все сохранения завершились ошибкой - пост без вложений не публикуем
+        lines.append(f'if (att == "") {{ return {{"post_id": 0, "items": {result_items}}}; }}')
+
+    params = ', '.join(f'{_literal(key)}: {_literal(value)}' for key, value in post_params.items() if value is not None)
+    lines.append(f'var post = API.wall.post({{{params}, "attachments": att}});')
+    lines.append(f'return {{"post_id": post.post_id, "items": {result_items}}};')
+    return '\n'.join(lines)
+
+async def publish(vk, uploader, media, **post_params):
+    """Публикует пост с вложениями двумя вызовами execute
+
+    Элементы media с типом 'attachment' - уже загруженные вложения, они попадают в пост как есть.
+    Возвращает ответ в формате wall.post ({"post_id": ...}) и список вложений в порядке media
+    (None для файлов, которые не удалось загрузить).
+    """
+    servers = {}
+    if any(kind != 'attachment' for kind, _, _ in media):
+        servers = await vk.method('execute', code=_build_servers_script(media))
+
+    async def upload(index, kind, path, title):
+        if kind == 'attachment':
+            return path
+
+        field, default_name = _UPLOAD_FIELDS[kind]
+        async with uploader.limiter:
+            if kind == 'video':
+                video = servers['videos'][str(index)]
+                await uploader.post_file(video['upload_url'], field, path, default_name)
+                return f'video{video["owner_id"]}_{video["video_id"]}'
+
+            uploaded = await uploader.post_file(servers[kind], field, path, default_name)
+        if kind == 'doc':
+            return {'file': uploaded['file'], 'title': title}
+        if kind == 'audio':
+            uploaded['title'] = title
+        return uploaded
+
+    async def upload_photos(photos):
+        async with uploader.limiter:
+            return await uploader.upload_wall_photos(servers['photo'], photos)
+
+    # Фото отправляются на сервер загрузки группами по PHOTOS_PER_UPLOAD файлов
+    photo_indexes = [index for index, (kind, _, _) in enumerate(media) if kind == 'photo']
+    batches = [
+        [photo_indexes[position] for position in batch]
+        for batch in photo_batches([media[index][1] for index in photo_indexes])
+    ]
+
+    # Файлы отправляются на серверы загрузки параллельно, порядок вложений сохраняется
+    results = await asyncio.gather(
+        *(upload(index, kind, path, title) for index, (kind, path, title) in enumerate(media) if kind != 'photo'),
+        *(upload_photos([media[index][1] for index in batch]) for batch in batches),
+        return_exceptions=True
+    )
+    other_results = iter(results[:len(media) - len(photo_indexes)])
+    batch_results = results[len(media) - len(photo_indexes):]
+
+    for result in results:
+        if isinstance(result, VkApiError) and result.code == AUTH_ERROR_CODE:
+            raise result
+
+    items = [(None, None)] * len(media)
+    for index, (kind, path, _) in enumerate(media):
+        if kind == 'photo':
+            continue
+        result = next(other_results)
+        if isinstance(result, Exception):
+            logging.error(f"Ошибка при загрузке файла {path} ({kind}): {result}")
+        else:
+            items[index] = (kind, result)
+
+    photo_uploads = []
+    for batch, result in zip(batches, batch_results):
+        if isinstance(result, Exception):
+            for index in batch:
+                logging.error(f"Ошибка при загрузке файла {media[index][1]} (photo): {result}")
+            continue
+        for position, index in enumerate(batch):
+            items[index] = ('photo', (len(photo_uploads), position))
+        photo_uploads.append(result)
+
+    if media and not any(kind for kind, _ in items):
+        raise RuntimeError("Не удалось загрузить ни одного вложения")
+
+    result = await vk.method('execute', code=_build_post_script(items, photo_uploads, post_params))
+    if not result or not result.get('post_id'):
+        raise RuntimeError("Не удалось сохранить вложения и опубликовать пост через execute")
+
+    attachments = [attachment or None for attachment in result.get('items') or []]
+    return {'post_id': result['post_id']}, attachments
@@ -1,9 +1,13 @@
+import asyncio
 import logging
 import os
-from typing import Optional, Dict
+from typing import Optional, Dict, List
 
-def get_entry(message_id: int) -> Optional[int]:
-    """Получает ID поста VK по ID сообщения Telegram"""
+from publish_context import PublishContext
+
+def get_entry(ctx: PublishContext) -> Optional[int]:
+    """Получает ID поста VK по ID сообщения Telegram для цели VK из контекста"""
+    message_id = ctx.message_id
     try:
         from config import supabase
         
@@ -22,7 +26,13 @@ def get_entry(message_id: int) -> Optional[int]:
             raise KeyError(f"Не найдено соответствие для сообщения {message_id}")
         
         # Получаем данные из Supabase из таблицы post_info
-        response = supabase.table("post_info").select("vk_post_id").eq("telegram_message_id", message_id).execute()
+        # ID сообщений Telegram уникальны только в пределах канала, поэтому фильтруем и по каналу
+        query = supabase.table("post_info").select("vk_post_id").eq("telegram_message_id", message_id)
+        if ctx.vk_target_id:
+            query = query.eq("vk_target_id", ctx.vk_target_id)
+        if ctx.telegram_channel_id:
+            query = query.eq("telegram_channel_id", ctx.telegram_channel_id)
+        response = query.execute()
         
         if response.data and len(response.data) > 0:
             return response.data[0]["vk_post_id"]
@@ -43,8 +53,12 @@ def get_entry(message_id: int) -> Optional[int]:
             logging.error(f"Ошибка при чтении из файла: {e}")
         raise KeyError(f"Не найдено соответствие для сообщения {message_id}")
 
-def add_entry(message_id: int, post_id: int, user_id: Optional[str] = None) -> bool:
-    """Сохраняет соответствие ID сообщения Telegram и поста VK в базе данных"""
+def add_entry(ctx: PublishContext, post_id: int, media: Optional[List[dict]] = None) -> bool:
+    """Сохраняет соответствие ID сообщения Telegram и поста VK в базе данных
+
+    media - вложения поста для post_media (file_id, file_type, vk_attachment_id).
+    """
+    message_id = ctx.message_id
     try:
         from config import supabase
         
@@ -56,8 +70,8 @@ def add_entry(message_id: int, post_id: int, user_id: Optional[str] = None) -> b
         
         from supabase_client import log_post
         
-        # Используем переданный user_id
-        log_post(user_id, message_id, post_id)
+        # user_id, цель VK и канал берутся из контекста публикации
+        log_post(ctx, post_id, media)
         return True
     except Exception as e:
         logging.error(f"Не удалось сохранить соответствие ID: {e}")
@@ -114,148 +128,155 @@ def get_source_link_for_edit(message_id: int) -> Optional[str]:
         logging.error(f"Ошибка при формировании ссылки: {e}")
         return f'https://t.me/{message_id}'
 
-def edit_vk_post(post_id: int, new_text: str, message_id: int) -> bool:
-    """Редактирует существующий пост VK"""
+def update_edited_post_records(ctx: PublishContext, post_id: int, new_text: str) -> None:
+    """Обновляет в базе данных информацию об отредактированном посте"""
+    message_id = ctx.message_id
     try:
-        from config import vk, VK_GROUP_ID
-        
-        if not vk:
-            logging.error("VK API клиент не инициализирован")
-            return False
+        from config import supabase
+
+        if not supabase:
+            logging.warning("Нет соединения с Supabase, не удалось обновить информацию о посте")
+            return
+
+        # Получаем информацию о посте из post_info
+        post_info_query = supabase.table("post_info").select("id,telegram_channel_id").eq("telegram_message_id", message_id)
+        if ctx.vk_target_id:
+            post_info_query = post_info_query.eq("vk_target_id", ctx.vk_target_id)
+        if ctx.telegram_channel_id:
+            post_info_query = post_info_query.eq("telegram_channel_id", ctx.telegram_channel_id)
+        post_info_query = post_info_query.execute()
+
+        if post_info_query.data and len(post_info_query.data) > 0:
+            post_info = post_info_query.data[0]
+            post_info_id = post_info["id"]
+
+            # Получаем текущее значение edit_count
+            post_info_details = supabase.table("post_info").select("edit_count").eq("id", post_info_id).execute()
+            current_edit_count = 1  # По умолчанию, если поле отсутствует
+
+            if post_info_details.data and len(post_info_details.data) > 0:
+                # Получаем текущее значение или используем 0, если оно отсутствует
+                current_edit_count = post_info_details.data[0].get("edit_count", 0) + 1
+
+            # Обновляем запись о посте в post_info
+            supabase.table("post_info").update({
+                "is_edited": True,
+                "edit_count": current_edit_count,
+                "updated_at": "now()"
+            }).eq("id", post_info_id).execute()
+
+            # Ищем связанный пост в таблице posts
+            posts_query = None
+
+            if "telegram_channel_id" in post_info and post_info["telegram_channel_id"]:
+                # Ищем по ID канала, так как это более надежный способ связи
+                posts_query = supabase.table("posts").select("id").eq("telegram_channel_id", post_info["telegram_channel_id"]).execute()
+
+            post_id_db = None
+
+            if not posts_query or not posts_query.data or len(posts_query.data) == 0:
+                # Ищем через post_content, так как там может быть связь с ID поста
+                content_query = supabase.table("post_content").select("post_id").eq("telegram_message_id", message_id).execute()
+                if content_query.data and len(content_query.data) > 0:
+                    post_id_db = content_query.data[0]["post_id"]
+                else:
+                    # Если не нашли, создаем новую запись в posts
+                    new_post_response = supabase.table("posts").insert({
+                        "is_active": True,
+                        "updated_at": "now()"
+                    }).execute()
+                    post_id_db = new_post_response.data[0]["id"] if new_post_response.data else None
+            else:
+                post_id_db = posts_query.data[0]["id"]
+
+            # Если нашли ID поста, обновляем связанные таблицы
+            if post_id_db:
+                # Обновляем статус в post_status
+                supabase.table("post_status").insert({
+                    "post_id": post_id_db,
+                    "status": "edited",
+                    "created_at": "now()"
+                }).execute()
+
+                # Обновляем post_metadata или создаем новую запись
+                metadata_query = supabase.table("post_metadata").select("id").eq("post_id", post_id_db).execute()
+                if metadata_query.data and len(metadata_query.data) > 0:
+                    # Получаем текущее значение edit_count в метаданных
+                    metadata_details = supabase.table("post_metadata").select("edit_count").eq("post_id", post_id_db).execute()
+                    current_metadata_edit_count = 1  # По умолчанию, если поле отсутствует
+
+                    if metadata_details.data and len(metadata_details.data) > 0:
+                        # Получаем текущее значение или используем 0, если оно отсутствует
+                        current_metadata_edit_count = metadata_details.data[0].get("edit_count", 0) + 1
+
+                    # Обновляем существующую запись
+                    supabase.table("post_metadata").update({
+                        "is_edited": True,
+                        "edit_count": current_metadata_edit_count,
+                        "updated_at": "now()"
+                    }).eq("post_id", post_id_db).execute()
+                else:
+                    # Создаем новую запись метаданных
+                    supabase.table("post_metadata").insert({
+                        "post_id": post_id_db,
+                        "is_edited": True,
+                        "edit_count": 1,
+                        "created_at": "now()",
+                        "updated_at": "now()"
+                    }).execute()
+
+                # Проверяем, есть ли запись в post_content
+                content_query = supabase.table("post_content").select("id").eq("post_id", post_id_db).execute()
+                if not content_query.data or len(content_query.data) == 0:
+                    # Создаем запись с текстом поста
+                    supabase.table("post_content").insert({
+                        "post_id": post_id_db,
+                        "telegram_message_id": message_id,
+                        "vk_post_id": post_id,
+                        "content": new_text,
+                        "created_at": "now()",
+                        "updated_at": "now()"
+                    }).execute()
+                else:
+                    # Обновляем существующую запись
+                    supabase.table("post_content").update({
+                        "content": new_text,
+                        "updated_at": "now()"
+                    }).eq("post_id", post_id_db).execute()
+    except Exception as db_error:
+        logging.error(f"Ошибка при обновлении информации о посте: {db_error}")
+
+async def edit_vk_post(ctx: PublishContext, post_id: int, new_text: str) -> bool:
+    """Редактирует существующий пост VK в цели из контекста публикации"""
+    message_id = ctx.message_id
+    try:
+        wall_post_id = f'{ctx.owner_id}_{post_id}'
         
         # Получаем оригинальный пост
-        old_post = vk.wall.getById(posts=f'-{VK_GROUP_ID}_{post_id}')[0]
+        old_post = (await ctx.call(lambda vk, uploader: vk.wall.getById(posts=wall_post_id)))[0]
         attachments = [f'{attachment["type"]}{attachment[attachment["type"]]["owner_id"]}_{attachment[attachment["type"]]["id"]}' for attachment in old_post.get('attachments', [])]
         
         # Получаем канал для формирования ссылки
-        response = vk.wall.getById(posts=f'-{VK_GROUP_ID}_{post_id}', copy_history_depth=0)
+        response = await ctx.call(lambda vk, uploader: vk.wall.getById(posts=wall_post_id, copy_history_depth=0))
         if not response:
             logging.error(f"Не удалось получить информацию о посте {post_id}")
             return False
             
         # Формируем ссылку на источник
-        source_link = get_source_link_for_edit(message_id)
+        source_link = await asyncio.to_thread(get_source_link_for_edit, message_id)
         
         # Редактируем пост
-        vk.wall.edit(
+        await ctx.call(lambda vk, uploader: vk.wall.edit(
             message=new_text,
             post_id=post_id,
             from_group=1,
-            owner_id=f'-{VK_GROUP_ID}',
+            owner_id=ctx.owner_id,
             copyright=source_link,
             attachments=','.join(attachments) if attachments else ''
-        )
+        ))
         
         # Обновляем информацию в базе данных
-        try:
-            from config import supabase
-            
-            if not supabase:
-                logging.warning("Нет соединения с Supabase, не удалось обновить информацию о посте")
-                return True
-            
-            # Получаем информацию о посте из post_info
-            post_info_query = supabase.table("post_info").select("id,telegram_channel_id").eq("telegram_message_id", message_id).execute()
-            
-            if post_info_query.data and len(post_info_query.data) > 0:
-                post_info = post_info_query.data[0]
-                post_info_id = post_info["id"]
-                
-                # Получаем текущее значение edit_count
-                post_info_details = supabase.table("post_info").select("edit_count").eq("id", post_info_id).execute()
-                current_edit_count = 1  # По умолчанию, если поле отсутствует
-                
-                if post_info_details.data and len(post_info_details.data) > 0:
-                    # Получаем текущее значение или используем 0, если оно отсутствует
-                    current_edit_count = post_info_details.data[0].get("edit_count", 0) + 1
-                
-                # Обновляем запись о посте в post_info
-                supabase.table("post_info").update({
-                    "is_edited": True,
-                    "edit_count": current_edit_count,
-                    "updated_at": "now()"
-                }).eq("id", post_info_id).execute()
-                
-                # Ищем связанный пост в таблице posts
-                posts_query = None
-                
-                if "telegram_channel_id" in post_info and post_info["telegram_channel_id"]:
-                    # Ищем по ID канала, так как это более надежный способ связи
-                    posts_query = supabase.table("posts").select("id").eq("telegram_channel_id", post_info["telegram_channel_id"]).execute()
-                
-                post_id_db = None
-                
-                if not posts_query or not posts_query.data or len(posts_query.data) == 0:
-                    # Ищем через post_content, так как там может быть связь с ID поста
-                    content_query = supabase.table("post_content").select("post_id").eq("telegram_message_id", message_id).execute()
-                    if content_query.data and len(content_query.data) > 0:
-                        post_id_db = content_query.data[0]["post_id"]
-                    else:
-                        # Если не нашли, создаем новую запись в posts
-                        new_post_response = supabase.table("posts").insert({
-                            "is_active": True,
-                            "updated_at": "now()"
-                        }).execute()
-                        post_id_db = new_post_response.data[0]["id"] if new_post_response.data else None
-                else:
-                    post_id_db = posts_query.data[0]["id"]
-                
-                # Если нашли ID поста, обновляем связанные таблицы
-                if post_id_db:
-                    # Обновляем статус в post_status
-                    supabase.table("post_status").insert({
-                        "post_id": post_id_db,
-                        "status": "edited",
-                        "created_at": "now()"
-                    }).execute()
-                    
-                    # Обновляем post_metadata или создаем новую запись
-                    metadata_query = supabase.table("post_metadata").select("id").eq("post_id", post_id_db).execute()
-                    if metadata_query.data and len(metadata_query.data) > 0:
-                        # Получаем текущее значение edit_count в метаданных
-                        metadata_details = supabase.table("post_metadata").select("edit_count").eq("post_id", post_id_db).execute()
-                        current_metadata_edit_count = 1  # По умолчанию, если поле отсутствует
-                        
-                        if metadata_details.data and len(metadata_details.data) > 0:
-                            # Получаем текущее значение или используем 0, если оно отсутствует
-                            current_metadata_edit_count = metadata_details.data[0].get("edit_count", 0) + 1
-                            
-                        # Обновляем существующую запись
-                        supabase.table("post_metadata").update({
-                            "is_edited": True,
-                            "edit_count": current_metadata_edit_count,
-                            "updated_at": "now()"
-                        }).eq("post_id", post_id_db).execute()
-                    else:
-                        # Создаем новую запись метаданных
-                        supabase.table("post_metadata").insert({
-                            "post_id": post_id_db,
-                            "is_edited": True,
-                            "edit_count": 1,
-                            "created_at": "now()",
-                            "updated_at": "now()"
-                        }).execute()
-                    
-                    # Проверяем, есть ли запись в post_content
-                    content_query = supabase.table("post_content").select("id").eq("post_id", post_id_db).execute()
-                    if not content_query.data or len(content_query.data) == 0:
-                        # Создаем запись с текстом поста
-                        supabase.table("post_content").insert({
-                            "post_id": post_id_db,
-                            "telegram_message_id": message_id,
-                            "vk_post_id": post_id,
-                            "content": new_text,
-                            "created_at": "now()",
-                            "updated_at": "now()"
-                        }).execute()
-                    else:
-                        # Обновляем существующую запись
-                        supabase.table("post_content").update({
-                            "content": new_text,
-                            "updated_at": "now()"
-                        }).eq("post_id", post_id_db).execute()
-        except Exception as db_error:
-            logging.error(f"Ошибка при обновлении информации о посте: {db_error}")
+        await asyncio.to_thread(update_edited_post_records, ctx, post_id, new_text)
         
         return True
     except Exception as e:
@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+import httpx
+
+import config
+from vk_async import AsyncVkApi, AsyncVkUpload, VkApiError, AUTH_ERROR_CODE
+
+# Пул клиентов VK API: ID цели VK -> клиент с постоянной HTTP-сессией, порядок - от давно использованных
+_clients = OrderedDict()
+
+# Токены, которые VK отклонил даже после повторной проверки: ID цели VK -> токен
+_rejected_tokens = {}
+
+# Фоновые задачи закрытия сессий (ссылки нужны, чтобы задачи не удалил сборщик мусора)
+_closing = set()
+
+def _pool_key(settings):
+    """Ключ пула - ID записи vk_targets (или ID группы, если записи нет)"""
+    return settings.get("vk_target_id") or settings["target_id"]
+
+def _create_client(key, token):
+    """Создает асинхронный клиент VK API с keep-alive соединениями"""
+    http = httpx.AsyncClient(
+        timeout=config.VK_HTTP_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=config.VK_POOL_CONNECTIONS,
+            max_keepalive_connections=config.VK_POOL_CONNECTIONS
+        )
+    )
+    vk = AsyncVkApi(token, http=http)
+    return {
+        "key": key,
+        "token": token,
+        "vk": vk,
+        "uploader": AsyncVkUpload(vk),
+        "last_used": time.monotonic(),
+        # Сколько вызовов сейчас выполняется клиентом и удален ли он из пула
+        "in_use": 0,
+        "retired": False
+    }
+
+async def _aclose(client):
+    try:
+        await client["vk"].aclose()
+    except Exception as e:
+        logging.warning(f"Ошибка при закрытии сессии VK для цели {client['key']}: {e}")
+
+def _close_client(client):
+    """Закрывает HTTP-клиент в фоне, не дожидаясь завершения"""
+    try:
+        task = asyncio.get_running_loop().create_task(_aclose(client))
+    except RuntimeError:
+        # Нет запущенного цикла событий - соединения закроются вместе с процессом
+        return
+    _closing.add(task)
+    task.add_done_callback(_closing.discard)
+
+def _retire(client):
+    """Убирает клиент из использования: сессия закрывается, когда завершится последний вызов"""
+    client["retired"] = True
+    if not client["in_use"]:
+        _close_client(client)
+
+def _evict_idle(now):
+    """Удаляет простаивающие клиенты и лишние клиенты сверх размера пула (LRU)"""
+    while _clients:
+        key, client = next(iter(_clients.items()))
+        if len(_clients) <= config.VK_POOL_SIZE and now - client["last_used"] < config.VK_POOL_IDLE_TTL:
+            break
+        del _clients[key]
+        _retire(client)
+        logging.debug(f"Клиент VK для цели {key} удален из пула")
+
+def _acquire(settings):
+    """Берет клиент VK API цели из пула (или создает его) на время вызова, см. _release"""
+    key = _pool_key(settings)
+    token = settings["access_token"]
+    now = time.monotonic()
+
+    client = _clients.pop(key, None)
+    if client and client["token"] != token:
+        # Токен цели изменился - старая сессия больше не нужна
+        _retire(client)
+        client = None
+
+    if not client:
+        client = _create_client(key, token)
+        logging.debug(f"Создан клиент VK для цели {key}")
+
+    client["last_used"] = now
+    client["in_use"] += 1
+    _clients[key] = client
+    _evict_idle(now)
+    return client
+
+def _release(client):
+    """Завершает вызов клиентом; клиент, удаленный из пула, закрывается после последнего вызова"""
+    client["in_use"] -= 1
+    if client["retired"] and not client["in_use"]:
+        _close_client(client)
+
+def evict(settings):
+    """Удаляет клиент цели VK из пула"""
+    client = _clients.pop(_pool_key(settings), None)
+    if client:
+        _retire(client)
+
+async def close_all():
+    """Закрывает сессии всех клиентов пула (при остановке бота)"""
+    clients = list(_clients.values())
+    _clients.clear()
+    await asyncio.gather(*(_aclose(client) for client in clients), *_closing)
+
+def is_token_rejected(settings):
+    """Проверяет, отклонял ли VK текущий токен цели с ошибкой авторизации"""
+    return _rejected_tokens.get(_pool_key(settings)) == settings["access_token"]
+
+def _reload_token(settings):
+    """Перечитывает токен цели VK из базы (его могли обновить в админке)"""
+    supabase = config.supabase
+    if not supabase or not settings.get("vk_target_id"):
+        return
+
+    try:
+        response = supabase.table("vk_targets")\
+            .select("access_token,refresh_token,expires_at,is_active")\
+            .eq("id", settings["vk_target_id"])\
+            .execute()
+        if response.data and response.data[0].get("is_active") and response.data[0].get("access_token"):
+            vk_data = response.data[0]
+            if vk_data["access_token"] != settings["access_token"]:
+                logging.info(f"Для цели VK {settings['target_id']} получен обновленный токен")
+            settings["access_token"] = vk_data["access_token"]
+            settings["refresh_token"] = vk_data.get("refresh_token")
+            settings["expires_at"] = vk_data.get("expires_at")
+    except Exception as e:
+        logging.error(f"Ошибка при получении токена цели VK {settings['target_id']} из базы: {e}")
+
+async def call(settings, func):
+    """Выполняет await func(vk, uploader) клиентом цели VK
+
+    Токен заранее не проверяется. Если VK ответил ошибкой авторизации (код 5),
+    клиент пересоздается с токеном из базы и вызов повторяется один раз.
+    """
+    client = _acquire(settings)
+    try:
+        try:
+            result = await func(client["vk"], client["uploader"])
+        except VkApiError as e:
+            if e.code != AUTH_ERROR_CODE:
+                raise
+            logging.warning(f"VK отклонил токен цели {settings['target_id']}: {e}, проверяем токен повторно")
+
+            evict(settings)
+            await asyncio.to_thread(_reload_token, settings)
+            previous, client = client, _acquire(settings)
+            _release(previous)
+            try:
+                result = await func(client["vk"], client["uploader"])
+            except VkApiError as retry_error:
+                if retry_error.code == AUTH_ERROR_CODE:
+                    _rejected_tokens[_pool_key(settings)] = settings["access_token"]
+                raise
+    finally:
+        _release(client)
+
+    _rejected_tokens.pop(_pool_key(settings), None)
+    return result
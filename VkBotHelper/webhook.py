@@ -0,0 +1,208 @@
+import asyncio
+import hmac
+import json
+import logging
+import secrets
+import signal
+import ssl
+import sys
+
+import httpx
+from telegram import Update
+
+import config
+
+# Бот публикует только посты каналов и их правки, остальные обновления Telegram не присылает
+ALLOWED_UPDATES = [Update.CHANNEL_POST, Update.EDITED_CHANNEL_POST]
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+
+REASONS = {
+    200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+    405: 'Method Not Allowed', 411: 'Length Required', 413: 'Payload Too Large'
+}
+
+def get_secret_token():
+    """Возвращает секрет вебхука из WEBHOOK_SECRET_TOKEN или создает случайный на время работы процесса"""
+    if not config.WEBHOOK_SECRET_TOKEN:
+        config.WEBHOOK_SECRET_TOKEN = secrets.token_urlsafe(32)
+    return config.WEBHOOK_SECRET_TOKEN
+
+async def _write_response(writer, status, keep_alive):
+    body = REASONS[status].encode('utf-8')
+    writer.write(
+        f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+        f"Content-Type: text/plain; charset=utf-8\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('utf-8') + body
+    )
+    await writer.drain()
+
+async def _read_request(reader):
+    """Читает строку запроса и заголовки: возвращает (метод, путь, заголовки) или None, если соединение закрыто"""
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError:
+        return None
+
+    lines = head.decode('latin-1').split('\r\n')
+    method, path, _ = lines[0].split(' ', 2)
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    return method, path.split('?', 1)[0], headers
+
+async def _handle_request(reader, writer, method, path, headers, application, secret_token):
+    """Проверяет запрос Telegram и передает обновление в очередь Application, возвращает код ответа"""
+    length = headers.get('content-length')
+    if method != 'POST':
+        return 405
+    if length is None:
+        return 411
+    length = int(length)
+    if length > config.WEBHOOK_MAX_BODY:
+        return 413
+
+    body = await reader.readexactly(length)
+    if path != config.WEBHOOK_PATH:
+        return 404
+    if not hmac.compare_digest(headers.get(SECRET_HEADER, ''), secret_token):
+        logging.warning("Запрос к вебхуку с неверным секретом отклонен")
+        return 403
+
+    try:
+        update = Update.de_json(json.loads(body), application.bot)
+    except Exception as e:
+        logging.warning(f"Не удалось разобрать обновление из вебхука: {e}")
+        return 400
+
+    # Telegram получает ответ сразу, обновление обрабатывается так же, как при опросе
+    await application.update_queue.put(update)
+    return 200
+
+async def start_server(application, secret_token):
+    """Запускает HTTP-сервер вебхука на WEBHOOK_LISTEN:WEBHOOK_PORT"""
+    async def serve(reader, writer):
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                method, path, headers = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                try:
+                    status = await _handle_request(reader, writer, method, path, headers, application, secret_token)
+                except (ValueError, asyncio.IncompleteReadError):
+                    status, keep_alive = 400, False
+                # После ошибки тело запроса могло остаться непрочитанным, соединение закрывается
+                keep_alive = keep_alive and status in (200, 403, 404)
+                await _write_response(writer, status, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError) as e:
+            logging.debug(f"Соединение с вебхуком прервано: {e}")
+        finally:
+            writer.close()
+
+    ssl_context = None
+    if config.WEBHOOK_CERT and config.WEBHOOK_KEY:
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(config.WEBHOOK_CERT, config.WEBHOOK_KEY)
+
+    server = await asyncio.start_server(serve, config.WEBHOOK_LISTEN, config.WEBHOOK_PORT, ssl=ssl_context)
+    logging.info(f"Вебхук принимает обновления на {config.WEBHOOK_LISTEN}:{config.WEBHOOK_PORT}{config.WEBHOOK_PATH}")
+    return server
+
+async def _serve(application):
+    secret_token = get_secret_token()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    # Тот же порядок, что и в run_polling: initialize, post_init, start ... stop, post_stop, shutdown, post_shutdown
+    await application.initialize()
+    server = None
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        server = await start_server(application, secret_token)
+        await application.start()
+
+        certificate = open(config.WEBHOOK_CERT, 'rb') if config.WEBHOOK_CERT else None
+        try:
+            await application.bot.set_webhook(
+                url=config.WEBHOOK_URL.rstrip('/') + config.WEBHOOK_PATH,
+                certificate=certificate,
+                secret_token=secret_token,
+                allowed_updates=ALLOWED_UPDATES,
+                max_connections=config.WEBHOOK_MAX_CONNECTIONS
+            )
+        finally:
+            if certificate:
+                certificate.close()
+        logging.info(f"Вебхук зарегистрирован в Telegram: {config.WEBHOOK_URL}")
+        await stop.wait()
+    finally:
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+        if application.running:
+            await application.stop()
+        # post_stop вызывается до shutdown(), пока HTTP-клиент бота еще открыт
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+def run(application):
+    """Запускает бота в режиме вебхука, аналог Application.run_polling (с вызовом post_init, post_stop и post_shutdown)"""
+    if not config.WEBHOOK_URL:
+        raise ValueError("Для режима вебхука нужно указать WEBHOOK_URL")
+    asyncio.run(_serve(application))
+
+async def selftest(path, url=None):
+    """Отправляет записанные обновления из файла на локальный вебхук и проверяет ответы
+
+    Файл содержит одно обновление, JSON-массив обновлений или по обновлению в строке.
+    Дополнительно проверяется, что запрос без верного секрета отклоняется.
+    """
+    url = url or f"http://127.0.0.1:{config.WEBHOOK_PORT}{config.WEBHOOK_PATH}"
+    with open(path, encoding='utf-8') as f:
+        text = f.read().strip()
+    try:
+        updates = json.loads(text)
+    except json.JSONDecodeError:
+        updates = [json.loads(line) for line in text.splitlines() if line.strip()]
+    if isinstance(updates, dict):
+        updates = [updates]
+
+    ok = True
+    async with httpx.AsyncClient(timeout=10) as client:
+        response = await client.post(url, json=updates[0] if updates else {}, headers={SECRET_HEADER: 'wrong'})
+        if response.status_code != 403:
+            logging.error(f"Запрос с неверным секретом вернул {response.status_code}, ожидался 403")
+            ok = False
+
+        for update in updates:
+            response = await client.post(url, json=update, headers={SECRET_HEADER: config.WEBHOOK_SECRET_TOKEN})
+            logging.info(f"Обновление {update.get('update_id')}: {response.status_code}")
+            ok = ok and response.status_code == 200
+    return ok
+
+if __name__ == '__main__':
+    # python webhook.py updates.json [url] - проверка работающего вебхука записанными обновлениями
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if len(sys.argv) < 2:
+        print("Использование: python webhook.py updates.json [url]")
+        sys.exit(2)
+    if not config.WEBHOOK_SECRET_TOKEN:
+        print("Укажите WEBHOOK_SECRET_TOKEN, с которым запущен бот")
+        sys.exit(2)
+    sys.exit(0 if asyncio.run(selftest(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)) else 1)